@@ -11,13 +11,21 @@ pip install websocket-client
 """
 
 import ssl
+import os
+import mmap
+import struct
+import zlib
 import threading
 import queue
+import collections
+import heapq
+import itertools
 import calendar
 import time
 import http.client
 from http.client import HTTPConnection, HTTPS_PORT
 import ipaddress
+import select
 import socket
 import websocket
 import logging
@@ -34,6 +42,9 @@ class CreateSendData:
         self.to_session_ids = []
         self.to_networks = []
         self.packet_type = None
+        self.priority = False  # True: sent in the control lane, ahead of other data
+        self.spool_record = None  # (segment number, start offset, end offset) of a packet read from a CywSpool
+        self.queued_time = None  # time.monotonic() when the packet was queued for upload
 
 
 class CywConstants:
@@ -45,8 +56,20 @@ class CywConstants:
         self.request_credentials = -2
         self.cancel_request = -3
         self.max_packet_size = 100000
+        self.max_messages_per_packet = 1000
+        self.batch_lookahead_size = 64
+        self.send_buffer_block = 'block'  # send_data waits for space in the send buffer
+        self.send_buffer_drop_oldest = 'drop_oldest'  # the oldest data in the send buffer is discarded
+        self.send_buffer_reject = 'reject'  # send_data returns error_send_buffer_full
+        self.default_control_lane_weight = 4
+        self.default_data_lane_weight = 1
+        self.default_send_buffer_block_timeout = 10
+        self.error_send_buffer_full = '30'
+        self.max_receive_buffer_size = 1048576
+        self.receive_chunk_size = 65536
         self.minimum_download_threshold_time = 5
-        self.download_error_wait_time = 5
+        self.download_error_wait_time = 5  # seconds, doubled after every failed download request in a row
+        self.download_error_max_wait_time = 60
         self.download_slippage_time = 2
         self.minimum_download_timeout = 10
         self.maximum_download_timeout = 1800
@@ -54,7 +77,7 @@ class CywConstants:
         self.download_decrease_time = 10
         self.state_request_credentials = 0
         self.state_running = 1
-        self.wait_before_retry_timeout = 5
+        self.wait_before_retry_timeout = 5000  # milliseconds
 
         self.ws_state_not_connected = 0
         self.ws_state_connected_not_auth = 1
@@ -66,8 +89,9 @@ class CywConstants:
         self.ws_state_restart_connection = 7
         self.ws_state_waiting_for_connection = 8
         self.terminating_string = "~t=1"
-        self.websocket_keep_alive_timeout = 30
-        self.websocket_keep_alive_sent_timeout = 10
+        self.terminating_bytes = b"~t=1"
+        self.websocket_keep_alive_timeout = 30000  # milliseconds
+        self.websocket_keep_alive_sent_timeout = 10000  # milliseconds
 
         self.use_test_server = False
         self.test_server_name = 'localhost:60061'
@@ -78,20 +102,99 @@ class CywCounters:
     def __init__(self):
         self.upload = 0
         self.download = 0
+        self.connection_hits = 0  # HTTP requests sent on a kept alive connection
+        self.connection_misses = 0  # HTTP requests that needed a new connection
+        self.connection_reconnects = 0  # kept alive connections that were closed by the server
+        self.batches = 0  # uploads that carried data
+        self.batch_bytes = 0  # total bytes of all the batches
+        self.batch_messages = 0  # total messages of all the batches
+        self.batch_bytes_max = 0  # size of the largest batch in bytes
+        self.batch_messages_max = 0  # most messages sent in one batch
+        self.send_buffer_dropped = 0  # messages discarded because the send buffer was full
+        self.send_buffer_rejected = 0  # messages not accepted by send_data because the send buffer was full
+        self.control_lane = CywLaneCounters()  # cancel requests, discovery and priority messages
+        self.data_lane = CywLaneCounters()
 
 
 class MasterThreadVariables:
     def __init__(self):
         self.waiting_for_response = False
-        self.wait_before_retry = 0
+        # 'retry': waiting for a response or before trying again, 'keep_alive': WebSocket keep alive,
+        # ('upload', upload counter): waiting for the response to an upload, 'spool_retry': waiting before spooled
+        # data of a failed upload is sent again
+        self.timers = CywTimers()
         self.stop_request_timeout_tick = None
         self.url = None
-        self.retry_count = 0
         self.max_retries = 3
-        self.last_packet_sent = True
-        self.last_packet_uploaded = None
-        self.retry_packet = None
         self.send_packet = None
+        self.send_window = 1  # number of uploads that can wait for a response at the same time
+        self.packets_in_flight = collections.OrderedDict()  # upload counter -> InFlightPacket, oldest first
+        # smooth weighted round robin between the control and data lanes when both have packets waiting
+        self.control_lane_credit = 0
+        self.data_lane_credit = 0
+
+
+# an upload that was sent and is waiting for a response
+class InFlightPacket:
+    def __init__(self, packet, upload_counter):
+        self.packet = packet
+        self.upload_counter = upload_counter
+        self.retry_count = 0
+
+
+# Timers of the master thread. The expiry times (time.monotonic()) are kept in a heap, so the master thread only
+# looks at the first one to know how long it can sleep. A timer that expired or was never started is not running
+class CywTimers:
+    def __init__(self):
+        self.now = time.monotonic()
+        self.__expiry = {}  # timer name -> expiry time
+        # (expiry time, sequence number, timer name), entries of timers that were restarted or stopped are
+        # skipped when they reach the top
+        self.__heap = []
+        self.__sequence = itertools.count()
+
+    def start(self, name, milliseconds):
+        """Start or restart a timer
+        :param name: Name of the timer
+        :param milliseconds: Time until the timer expires
+        """
+        expiry = time.monotonic() + milliseconds / 1000.0
+        self.__expiry[name] = expiry
+        heapq.heappush(self.__heap, (expiry, next(self.__sequence), name))
+        if len(self.__heap) > 2 * len(self.__expiry) + 16:
+            # drop the entries of restarted timers, a timer that is restarted often does not grow the heap
+            self.__heap = [entry for entry in self.__heap if self.__expiry.get(entry[2]) == entry[0]]
+            heapq.heapify(self.__heap)
+
+    def stop(self, name):
+        self.__expiry.pop(name, None)
+
+    def is_running(self, name):
+        return name in self.__expiry
+
+    def update(self):
+        """Read the clock and stop the timers that expired
+        :return: List with the names of the timers that expired
+        """
+        self.now = time.monotonic()
+        expired = []
+        heap = self.__heap
+        while len(heap) > 0 and heap[0][0] <= self.now:
+            expiry, sequence, name = heapq.heappop(heap)
+            if self.__expiry.get(name) == expiry:
+                del self.__expiry[name]
+                expired.append(name)
+        return expired
+
+    def get_wait_time(self):
+        """Return the number of seconds until the next timer expires, None if no timer is running
+        """
+        heap = self.__heap
+        while len(heap) > 0 and self.__expiry.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+        if len(heap) == 0:
+            return None
+        return max(0.0, heap[0][0] - time.monotonic())
 
 
 class CloudSendPacket:
@@ -103,26 +206,166 @@ class CloudSendPacket:
         self.data_packet = False
         self.default_params = ''
         self.data_type = ''
+        self.queued_time = None  # time.monotonic() when the packet was queued for upload
+
+
+# messages sent through one lane of the send buffer, see CywCounters
+class CywLaneCounters:
+    def __init__(self):
+        self.depth = 0  # messages waiting, updated when get_counters is called
+        self.depth_bytes = 0
+        self.messages = 0  # messages sent
+        self.wait_time_total = 0.0  # seconds the sent messages waited in the lane
+        self.wait_time_max = 0.0
 
 
 class UploadResponse:
     def __init__(self):
         self.response = ''
         self.packet_type = False
+        self.upload_counter = None
 
 
 class DownloadResponse:
     def __init__(self):
         self.error_code = '0'
-        self.data = ''
+        self.data = b''
         self.data_type = ''
         self.from_who = -1
 
 
 class CreateCywDictionary:
     def __init__(self):
+        """
+        Ordered multi-map with the keys and values of a message. keys and values are parallel lists in the order
+        the keys were received, an index with a list of values per key is kept up to date for lookups
+        """
         self.keys = []
         self.values = []
+        self._index = {}
+        self._indexed = 0  # number of entries in the index, keys appended directly are indexed on lookup
+
+    def add(self, key, value):
+        self.keys.append(key)
+        self.values.append(value)
+
+    def _update_index(self):
+        index = self._index
+        for i in range(self._indexed, len(self.keys)):
+            key_values = index.get(self.keys[i])
+            if key_values is None:
+                index[self.keys[i]] = [self.values[i]]
+            else:
+                key_values.append(self.values[i])
+        self._indexed = len(self.keys)
+
+    def get_values(self, key):
+        """Return the list of values of a key, in the order they were received. The list must not be modified
+        :param key: Key to look for
+        :return: List of values, empty if the key is not present
+        """
+        if self._indexed != len(self.keys):
+            self._update_index()
+        return self._index.get(key, [])
+
+    def get_single_value(self, key):
+        """Return the first value of a key
+        :param key: Key to look for
+        :return: The first value, None if the key is not present
+        """
+        if self._indexed != len(self.keys):
+            self._update_index()
+        key_values = self._index.get(key)
+        if key_values is None:
+            return None
+        return key_values[0]
+
+    def items(self):
+        """Iterate over the (key, value) pairs in the order they were received
+        """
+        return zip(self.keys, self.values)
+
+
+class CywStreamDecoder:
+    def __init__(self, terminator=b'~t=1', max_buffer_size=1048576, bytes_keys=('d',)):
+        """
+        Resumable decoder for messages that are received in chunks. Data is added with feed() as it is received,
+        the search for the terminator continues where the previous chunk ended and every message is decoded
+        as soon as it is complete. Decoded data is removed from the front of the buffer without copying the rest
+        :param terminator: The bytes at the end of every message, None if the end of the data ends the message
+        :param max_buffer_size: The maximum number of bytes of an incomplete message that will be buffered
+        :param bytes_keys: The keys of which the values are left as bytes
+        """
+        self.terminator = terminator
+        self.max_buffer_size = max_buffer_size
+        self.bytes_keys = bytes_keys
+        self.overflows = 0
+        self._buf = bytearray()
+        self._scan_pos = 0  # position from which the search for the terminator continues
+        self._skip = False  # set after an overflow, data is discarded up to the end of the message
+
+    def reset(self):
+        """Discard all buffered data, used when a new connection is started
+        """
+        self._buf = bytearray()
+        self._scan_pos = 0
+        self._skip = False
+
+    def get_buffered_size(self):
+        return len(self._buf)
+
+    def feed(self, data):
+        """Add received data
+        :param data: bytes, bytearray or memoryview
+        :return: A list with a CYW dictionary for every message that was completed by the data
+        """
+        messages = []
+        if self._skip and self.terminator is None:
+            return messages  # the rest of the data belongs to the message that was too long
+        buf = self._buf
+        buf += data
+        if self.terminator is not None:
+            terminator = self.terminator
+            start = 0
+            while True:
+                index = buf.find(terminator, self._scan_pos)
+                if index < 0:
+                    break
+                # a tilde that follows an odd number of tildes is the second half of an escaped tilde
+                tildes = 0
+                while index - tildes > start and buf[index - tildes - 1] == 0x7e:
+                    tildes += 1
+                if tildes % 2 == 1:
+                    self._scan_pos = index + 1
+                    continue
+                end = index + len(terminator)
+                if self._skip:
+                    self._skip = False  # the rest of the message that was too long
+                else:
+                    messages.append(CywInterface.decode_cyw_protocol(bytes(memoryview(buf)[start:end]),
+                                                                      self.bytes_keys))
+                start = end
+                self._scan_pos = end
+            if start > 0:
+                del buf[:start]
+                self._scan_pos -= start
+            # the end of the buffer can hold the first part of a terminator
+            self._scan_pos = max(self._scan_pos, len(buf) - len(terminator) + 1)
+        if len(buf) > self.max_buffer_size:
+            self.overflows += 1
+            self.reset()
+            self._skip = True
+        return messages
+
+    def finish(self):
+        """Decode the buffered data as the last message, used when the end of the data ends the message
+        :return: A CYW dictionary, None if there was no data, it could not be decoded or the buffer overflowed
+        """
+        message = None
+        if not self._skip and len(self._buf) > 0:
+            message = CywInterface.decode_cyw_protocol(self._buf, self.bytes_keys)
+        self.reset()
+        return message
 
 
 # local variables used in CywInterface class
@@ -135,8 +378,6 @@ class CywLocals:
         self.upload_params = ''
         self.download_ssl_url = ''
         self.upload_ssl_url = ''
-        self.ssl_context_download = None
-        self.ssl_context_upload = None
         self.auth_params = ''
         self.download_page = ''
         self.error_codes = CreateCywDictionary()
@@ -147,9 +388,17 @@ class CywLocals:
         self.session_id = -1
         self.use_encryption = False
         self.service_running = False
-        self.to_master_for_cloud_queue = CywQueue()  # special queue that allows us to push one item to the front
-        self.from_to_cloud_to_master_queue = queue.Queue()
-        self.from_from_cloud_to_master_queue = queue.Queue()
+        # the master thread sleeps until master_wakeup is set or its next timer expires, the queues it reads
+        # set master_wakeup when something is added
+        self.master_wakeup = threading.Event()
+        # notified when the connection type or state changes, the download and WebSocket threads wait on this
+        # while they have nothing to do
+        self.thread_condition = threading.Condition()
+        # special queue that allows us to push one item to the front
+        self.to_master_for_cloud_queue = CywQueue(self.master_wakeup, CywQueue.get_data_size)  # data lane
+        self.to_master_for_cloud_control_queue = CywQueue(self.master_wakeup, CywQueue.get_data_size)  # control lane
+        self.from_to_cloud_to_master_queue = CywQueue(self.master_wakeup)
+        self.from_from_cloud_to_master_queue = CywQueue(self.master_wakeup)
         self.to_cloud_queue = queue.Queue()
         self.last_sent_data = None
         self.closing_threads = False
@@ -164,16 +413,36 @@ class CywLocals:
 
         # counters
         self.counters = CywCounters()
+        self.connection_pool = CywConnectionPool(self.counters)
 
         # state
         self.constants = CywConstants()
         self.cyw_state = self.constants.state_request_credentials
         self.download_timeout = self.constants.default_download_request_timeout
+        self.max_packet_size = self.constants.max_packet_size  # byte limit of the data in one upload
+        self.max_messages_per_packet = self.constants.max_messages_per_packet
+        self.batch_lookahead_size = self.constants.batch_lookahead_size  # queued packets considered per upload
+        # send buffer, data from send_data waiting to be uploaded
+        self.max_send_buffer_size = 0  # bytes, 0 for no limit
+        self.send_buffer_policy = self.constants.send_buffer_reject
+        self.send_buffer_block_timeout = self.constants.default_send_buffer_block_timeout
+        self.send_buffer_high_watermark = 0  # bytes, 0 disables the watermark callbacks
+        self.send_buffer_low_watermark = 0
+        self.send_buffer_above_high_watermark = False
+        self.send_buffer_watermark_lock = threading.RLock()  # a callback can send data, which checks again
+        self.spool = None  # CywSpool used instead of the send buffer for data packets, see set_spool_directory
+        self.control_lane_weight = self.constants.default_control_lane_weight
+        self.data_lane_weight = self.constants.default_data_lane_weight
+        self.interactive_message_size = 0  # messages up to this size are sent in the control lane, 0 disables
 
         # callbacks
         self.data_received_callback = None
+        self.receive_bytes = False  # if True data_received_callback is called with bytes instead of str
+        self.string_encoding = 'latin-1'  # conversion between str data and the bytes that are sent and received
         self.connection_status_callback = None
         self.error_callback = None
+        self.high_watermark_callback = None
+        self.low_watermark_callback = None
 
         # master thread variables
         self.master_vars = MasterThreadVariables()
@@ -182,7 +451,7 @@ class CywLocals:
         self.master_thread = None
         self.master_thread_running = False
         self.master_thread_terminated = True
-        self.upload_thread = None
+        self.upload_threads = []
         self.upload_thread_running = False
         self.upload_thread_terminated = True
         self.download_thread = None
@@ -195,10 +464,11 @@ class CywLocals:
 
         # WebSocket
         self.websocket_state = self.constants.ws_state_not_connected
-        self.tick_websocket_keep_alive = calendar.timegm(time.gmtime())
         self.keep_alive_sent = False
-        self.websocket_rec_data_buf = ''
-        self.websocket_receive_queue = queue.Queue()
+        self.websocket_decoder = CywStreamDecoder(self.constants.terminating_bytes,
+                                                  self.constants.max_receive_buffer_size)
+        self.download_decoder = CywStreamDecoder(None, self.constants.max_receive_buffer_size)
+        self.websocket_receive_queue = CywQueue(self.master_wakeup)
         self.websocket_url = ''
         self.websocket_ssl_url = ''
         self.use_websocket = True
@@ -213,41 +483,553 @@ class CywNewInstance:
         pass
 
 
-# Custom Control Your Way queue which allows us to push one item back to the front.
-# This is important because the last popped packet might not be able to be added to the current packet sent to the
-# server, then it is important to put it back to the front of the queue
+# Custom Control Your Way queue which allows us to push items back to the front.
+# This is important because packets taken from the queue might not be able to be added to the current packet sent to
+# the server, then it is important to put them back to the front of the queue. All methods can be called from
+# different threads at the same time, the number of items and the number of bytes they hold are counted exactly
 class CywQueue:
-    def __init__(self):
-        self.__queue = queue.Queue()
-        self.__unshifted_item = None  # this variable hold an item that was pushed in front
-        self.__queue_count = 0
+    def __init__(self, wakeup=None, item_size=None):
+        self.__items = collections.deque()
+        self.__lock = threading.Lock()
+        self.__space = threading.Condition(self.__lock)  # notified when items are removed
+        self.__bytes = 0
+        self.__wakeup = wakeup  # event that is set when an item is added
+        self.__item_size = item_size  # function that returns the number of bytes of an item, None counts 0 bytes
+
+    @staticmethod
+    def get_data_size(item):
+        """Return the number of bytes of the data of a packet, used as item_size for queues of packets
+        :param item: Packet with a data attribute or None
+        :return: Length of the data
+        """
+        if item is None:
+            return 0
+        return len(item.data)
+
+    def __size(self, item):
+        if self.__item_size is None:
+            return 0
+        return self.__item_size(item)
 
     def put(self, item):
-        self.__queue.put(item)
-        self.__queue_count += 1
+        with self.__lock:
+            self.__items.append(item)
+            self.__bytes += self.__size(item)
+        if self.__wakeup is not None:
+            self.__wakeup.set()
 
     def get(self):
-        if self.__unshifted_item is not None:
-            # return the value that was pushed to the front previously
-            return_value = self.__unshifted_item
-            self.__unshifted_item = None
-            self.__queue_count -= 1
-            return return_value
-        else:
-            self.__queue_count -= 1
-            return self.__queue.get()
+        """Remove the item at the front of the queue
+        :return: The item, None if the queue is empty
+        """
+        with self.__lock:
+            if not self.__items:
+                return None
+            item = self.__items.popleft()
+            self.__bytes -= self.__size(item)
+            self.__space.notify_all()
+            return item
+
+    def drain(self, max_bytes=None, max_items=None):
+        """Remove items from the front of the queue under one lock. The first item is always removed, even if it is
+        larger than max_bytes
+        :param max_bytes: Maximum total size of the items, None for no limit
+        :param max_items: Maximum number of items, None for no limit
+        :return: List of items in queue order, empty if the queue is empty
+        """
+        items = []
+        total = 0
+        with self.__lock:
+            while self.__items and (max_items is None or len(items) < max_items):
+                size = self.__size(self.__items[0])
+                if items and max_bytes is not None and total + size > max_bytes:
+                    break
+                items.append(self.__items.popleft())
+                total += size
+            self.__bytes -= total
+            if items:
+                self.__space.notify_all()
+        return items
+
+    def put_limited(self, item, max_bytes, drop_oldest=False, timeout=0, can_drop=None):
+        """Add an item if the queue does not hold more than max_bytes after it was added. An item is always added to
+        an empty queue, even if it is larger than max_bytes
+        :param item: Item to add
+        :param max_bytes: Maximum number of bytes in the queue
+        :param drop_oldest: Remove items from the front of the queue until the item fits
+        :param timeout: Seconds to wait for other threads to remove items until the item fits, 0 does not wait and
+        None waits until there is space
+        :param can_drop: Function that returns True for items that may be removed by drop_oldest, None for all items
+        :return: Tuple of True if the item was added and a list of the items that were removed to make space
+        """
+        size = self.__size(item)
+        dropped = []
+        with self.__space:
+            if drop_oldest:
+                kept = []
+                while self.__items and self.__bytes + size > max_bytes:
+                    old_item = self.__items.popleft()
+                    if can_drop is None or can_drop(old_item):
+                        self.__bytes -= self.__size(old_item)
+                        dropped.append(old_item)
+                    else:
+                        kept.append(old_item)
+                self.__items.extendleft(reversed(kept))
+            elif timeout is None or timeout > 0:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while self.__items and self.__bytes + size > max_bytes:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self.__space.wait(remaining)
+            if self.__items and self.__bytes + size > max_bytes:
+                return False, dropped
+            self.__items.append(item)
+            self.__bytes += size
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+        return True, dropped
 
     def empty(self):
-        if self.__queue.empty() and self.__unshifted_item is None:
-            return True
-        return False
+        return not self.__items
 
-    def unshift(self, item):
-        self.__unshifted_item = item
-        self.__queue_count += 1
+    def unshift(self, *items):
+        """Push items back to the front of the queue, the first item given will be the first item in the queue
+        :param items: Items to push back
+        """
+        with self.__lock:
+            for item in reversed(items):
+                self.__items.appendleft(item)
+                self.__bytes += self.__size(item)
 
     def get_size(self):
-        return self.__queue_count
+        return len(self.__items)
+
+    def get_bytes(self):
+        return self.__bytes
+
+
+# a memory-mapped file of the spool, see CywSpool
+class CywSpoolSegment:
+    def __init__(self, number, path, file, mm):
+        self.number = number
+        self.path = path
+        self.file = file
+        self.mm = mm
+        self.size = len(mm)
+        self.write_offset = CywSpool.header_size  # offset where the next record is written
+        self.acked_offset = CywSpool.header_size  # all records before this offset were acknowledged
+        self.acked_ends = set()  # end offsets of records after acked_offset that were acknowledged out of order
+        self.version = CywSpool.version  # format of the records, segments of an older version are read as they are
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+# Append-only store for data packets waiting to be uploaded, used instead of the send buffer in memory so that data
+# survives a restart of the application and a long disconnect. Packets are appended as records to memory-mapped
+# segment files and read back by the master thread in the same order, it has the same drain and unshift methods as
+# CywQueue. A segment file is deleted once the server acknowledged all the packets in it.
+# Segment file: header (magic, version, acked offset), then records (payload length, CRC32 of payload, payload).
+# Version 1 records do not have the time the packet was queued
+class CywSpool:
+    header_format = '<4sII'
+    header_size = struct.calcsize(header_format)
+    record_format = '<II'
+    record_header_size = struct.calcsize(record_format)
+    magic = b'CYWS'
+    version = 2
+
+    def __init__(self, directory, max_size=67108864, segment_size=1048576, wakeup=None):
+        self.directory = directory
+        self.max_size = max_size  # maximum number of bytes of all segment files together
+        self.segment_size = segment_size
+        self.__wakeup = wakeup  # event that is set when a packet is added
+        self.__data_packet = CywConstants().data_packet
+        self.__lock = threading.Lock()
+        self.__segments = collections.OrderedDict()  # segment number -> CywSpoolSegment, oldest first
+        self.__total_size = 0
+        self.__read_segment = None  # segment number and offset of the next record to read
+        self.__read_offset = 0
+        self.__unread_count = 0
+        self.__unread_bytes = 0
+        self.__next_number = 0  # number of the next segment that is created
+        os.makedirs(directory, exist_ok=True)
+        self.__open_segments()
+
+    @staticmethod
+    def encode_packet(packet):
+        """Convert an upload data packet to a record payload. The fields are separated by ASCII 0, which does not
+        occur in tilde encoded values
+        :param packet: Data packet with tilde encoded data, data type and networks
+        :return: bytes
+        """
+        # the time the packet was queued is stored as wall clock time, monotonic time does not survive a restart
+        queued_time = time.time()
+        if packet.queued_time is not None:
+            queued_time -= time.monotonic() - packet.queued_time
+        fields = [('%.3f' % queued_time).encode(), packet.data_type.encode(), str(len(packet.to_networks)).encode()]
+        fields.extend(network.encode() for network in packet.to_networks)
+        fields.append(str(len(packet.to_session_ids)).encode())
+        fields.extend(str(session_id).encode() for session_id in packet.to_session_ids)
+        fields.append(packet.data)
+        return b'\x00'.join(fields)
+
+    @staticmethod
+    def decode_packet(payload, version=None):
+        """Convert a record payload back to an upload data packet, see encode_packet
+        :param payload: bytes
+        :param version: Version of the segment the record was read from, None for the current version
+        :return: CreateSendData
+        """
+        fields = payload.split(b'\x00')
+        packet = CreateSendData()
+        if version == 1:
+            packet.queued_time = time.monotonic()  # not stored, the packet is counted as queued now
+        else:
+            packet.queued_time = time.monotonic() - (time.time() - float(fields[0]))
+            fields = fields[1:]
+        packet.data_type = fields[0].decode()
+        network_count = int(fields[1])
+        packet.to_networks = [field.decode() for field in fields[2:2 + network_count]]
+        session_id_count = int(fields[2 + network_count])
+        packet.to_session_ids = [field.decode() for field in fields[3 + network_count:3 + network_count +
+                                                                      session_id_count]]
+        packet.data = fields[-1]
+        return packet
+
+    def __get_path(self, number):
+        return os.path.join(self.directory, 'cyw_spool_%010d.seg' % number)
+
+    def __open_segments(self):
+        # open the segments left by a previous run, the packets that were not acknowledged are sent again
+        numbers = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith('cyw_spool_') and filename.endswith('.seg'):
+                try:
+                    numbers.append(int(filename[10:-4]))
+                except ValueError:
+                    pass
+        # new segments are numbered after all the segment files, also the ones that are not used, so that a file
+        # is never overwritten
+        self.__next_number = max(numbers) + 1 if numbers else 0
+        for number in sorted(numbers):
+            path = self.__get_path(number)
+            f = open(path, 'r+b')
+            size = os.fstat(f.fileno()).st_size
+            if size < self.header_size:
+                f.close()
+                os.remove(path)
+                continue
+            mm = mmap.mmap(f.fileno(), size)
+            magic, version, acked_offset = struct.unpack_from(self.header_format, mm, 0)
+            if magic != self.magic or version not in (1, self.version):
+                mm.close()
+                f.close()
+                continue  # not a spool segment of a version that can be read, leave it alone
+            segment = CywSpoolSegment(number, path, f, mm)
+            segment.version = version
+            # the records end at the first record that is empty or not completely written
+            offset = self.header_size
+            while offset + self.record_header_size <= size:
+                length, crc = struct.unpack_from(self.record_format, mm, offset)
+                end = offset + self.record_header_size + length
+                if length == 0 or end > size or \
+                        zlib.crc32(mm[offset + self.record_header_size:end]) != crc:
+                    break
+                offset = end
+            segment.write_offset = offset
+            segment.acked_offset = min(max(acked_offset, self.header_size), offset)
+            self.__segments[number] = segment
+            self.__total_size += segment.size
+        self.__remove_acked_segments()
+        self.rewind()
+
+    def __create_segment(self, number, size):
+        path = self.__get_path(number)
+        f = open(path, 'w+b')
+        f.truncate(size)
+        mm = mmap.mmap(f.fileno(), size)
+        struct.pack_into(self.header_format, mm, 0, self.magic, self.version, self.header_size)
+        segment = CywSpoolSegment(number, path, f, mm)
+        self.__segments[number] = segment
+        self.__total_size += size
+        return segment
+
+    def __remove_acked_segments(self):
+        # delete the oldest segments of which all records were acknowledged, the last segment is kept for appending
+        while len(self.__segments) > 1:
+            segment = next(iter(self.__segments.values()))
+            if segment.acked_offset < segment.write_offset:
+                break
+            del self.__segments[segment.number]
+            self.__total_size -= segment.size
+            segment.close()
+            os.remove(segment.path)
+
+    def __get_read_segment(self):
+        # return the segment of the next record to read, None if all records were read
+        for number, segment in self.__segments.items():
+            if number < self.__read_segment:
+                continue
+            if number > self.__read_segment:
+                self.__read_segment = number
+                self.__read_offset = self.header_size
+            if self.__read_offset < segment.acked_offset:
+                self.__read_offset = segment.acked_offset
+            if self.__read_offset < segment.write_offset:
+                return segment
+        return None
+
+    def put(self, packet):
+        """Append a data packet
+        :param packet: Data packet with tilde encoded data, data type and networks
+        :return: True if successful, False if the spool is full
+        """
+        payload = self.encode_packet(packet)
+        record_size = self.record_header_size + len(payload)
+        with self.__lock:
+            segment = None
+            if self.__segments:
+                segment = next(reversed(self.__segments.values()))
+            # records are only appended to a segment of the current version
+            if segment is None or segment.write_offset + record_size > segment.size or \
+                    segment.version != self.version:
+                size = max(self.segment_size, self.header_size + record_size)
+                if self.__total_size + size > self.max_size:
+                    return False
+                if segment is not None:
+                    segment.mm.flush()  # the segment is complete, write it to disk
+                segment = self.__create_segment(self.__next_number, size)
+                self.__next_number += 1
+                if self.__read_segment is None:
+                    self.__read_segment = segment.number
+            offset = segment.write_offset
+            struct.pack_into(self.record_format, segment.mm, offset, len(payload), zlib.crc32(payload))
+            segment.mm[offset + self.record_header_size:offset + record_size] = payload
+            segment.write_offset += record_size
+            self.__unread_count += 1
+            self.__unread_bytes += len(payload)
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+        return True
+
+    def drain(self, max_bytes=None, max_items=None):
+        """Read packets in the order they were added, see CywQueue.drain. The spool_record of every packet is set so
+        that it can be passed to unshift and ack
+        :param max_bytes: Maximum total size of the packets, None for no limit
+        :param max_items: Maximum number of packets, None for no limit
+        :return: List of packets
+        """
+        items = []
+        total = 0
+        with self.__lock:
+            while self.__read_segment is not None and (max_items is None or len(items) < max_items):
+                segment = self.__get_read_segment()
+                if segment is None:
+                    break
+                offset = self.__read_offset
+                length, crc = struct.unpack_from(self.record_format, segment.mm, offset)
+                if items and max_bytes is not None and total + length > max_bytes:
+                    break
+                end = offset + self.record_header_size + length
+                packet = self.decode_packet(segment.mm[offset + self.record_header_size:end], segment.version)
+                packet.packet_type = self.__data_packet
+                packet.spool_record = (segment.number, offset, end)
+                items.append(packet)
+                total += length
+                self.__read_offset = end
+                self.__unread_count -= 1
+                self.__unread_bytes -= length
+        return items
+
+    def unshift(self, *items):
+        """Read packets again that were returned by drain, the first item given is read first
+        :param items: Packets in the order drain returned them
+        """
+        if not items:
+            return
+        with self.__lock:
+            self.__read_segment, self.__read_offset, end = items[0].spool_record
+            for item in items:
+                number, offset, end = item.spool_record
+                self.__unread_count += 1
+                self.__unread_bytes += end - offset - self.record_header_size
+
+    def ack(self, items):
+        """Mark packets as received by the server, segments of which all packets were acknowledged are deleted
+        :param items: Packets returned by drain
+        """
+        with self.__lock:
+            for item in items:
+                number, offset, end = item.spool_record
+                segment = self.__segments.get(number)
+                if segment is None or end <= segment.acked_offset:
+                    continue  # sent more than once and already acknowledged
+                segment.acked_ends.add(end)
+                acked_offset = segment.acked_offset
+                while acked_offset < segment.write_offset:
+                    length, crc = struct.unpack_from(self.record_format, segment.mm, acked_offset)
+                    record_end = acked_offset + self.record_header_size + length
+                    if record_end not in segment.acked_ends:
+                        break
+                    segment.acked_ends.discard(record_end)
+                    if self.__read_segment is not None and \
+                            (number, acked_offset) >= (self.__read_segment, self.__read_offset):
+                        # the record was read again after a rewind and is not read anymore, it is skipped by
+                        # __get_read_segment
+                        self.__unread_count -= 1
+                        self.__unread_bytes -= length
+                    acked_offset = record_end
+                if acked_offset != segment.acked_offset:
+                    segment.acked_offset = acked_offset
+                    struct.pack_into(self.header_format, segment.mm, 0, self.magic, segment.version, acked_offset)
+            self.__remove_acked_segments()
+
+    def rewind(self):
+        """Read all the packets that were not acknowledged again, used when uploads were lost"""
+        with self.__lock:
+            self.__read_segment = None
+            self.__unread_count = 0
+            self.__unread_bytes = 0
+            for number, segment in self.__segments.items():
+                if self.__read_segment is None:
+                    self.__read_segment = number
+                    self.__read_offset = segment.acked_offset
+                offset = segment.acked_offset
+                while offset < segment.write_offset:
+                    length, crc = struct.unpack_from(self.record_format, segment.mm, offset)
+                    offset += self.record_header_size + length
+                    self.__unread_count += 1
+                    self.__unread_bytes += length
+
+    def empty(self):
+        return self.__unread_count == 0
+
+    def get_size(self):
+        return self.__unread_count
+
+    def get_bytes(self):
+        return self.__unread_bytes
+
+    def get_disk_usage(self):
+        return self.__total_size
+
+    def flush(self):
+        # write the segments to disk, data in memory-mapped files survives a crash of the application but not
+        # of the operating system before it is written
+        with self.__lock:
+            for segment in self.__segments.values():
+                segment.mm.flush()
+
+    def close(self):
+        with self.__lock:
+            for segment in self.__segments.values():
+                segment.mm.flush()
+                segment.close()
+            self.__segments.clear()
+            self.__read_segment = None
+            self.__unread_count = 0
+            self.__unread_bytes = 0
+
+
+# HTTP/1.1 connections to the server are kept open after a request and used again for the next request to the
+# same host, this saves a TCP and TLS handshake for every upload and download request
+class CywConnectionPool:
+    def __init__(self, counters, max_idle_connections=2, max_idle_time=10):
+        self.counters = counters
+        self.max_idle_connections = max_idle_connections  # per host
+        self.max_idle_time = max_idle_time  # seconds, the server can close connections that are not used
+        self.ssl_context = None  # shared by all encrypted connections
+        self.__lock = threading.Lock()
+        self.__idle = {}  # (host, port, encrypted) -> list of [connection, time it was released]
+
+    def get_ssl_context(self):
+        with self.__lock:
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            return self.ssl_context
+
+    @staticmethod
+    def connection_is_closed(con):
+        # an idle connection must not have data waiting, if it has the server closed the connection. With TLS
+        # the server can send session tickets after the handshake so only a failed request can be detected
+        if con.sock is None:
+            return True
+        if isinstance(con.sock, ssl.SSLSocket):
+            return False
+        try:
+            readable, writable, errors = select.select([con.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return len(readable) > 0
+
+    def __get_idle_connection(self, key):
+        with self.__lock:
+            idle = self.__idle.get(key)
+            while idle:
+                con, released_time = idle.pop()
+                if time.monotonic() - released_time < self.max_idle_time and not self.connection_is_closed(con):
+                    return con
+                con.close()
+        return None
+
+    def request(self, host, port, encrypted, timeout, method, page, body, headers):
+        """Send a request on a kept alive connection to the host, or on a new connection if there is none.
+        If a kept alive connection was closed by the server the request is sent again on a new connection
+        :param host: Host name, can include the port
+        :param port: Port number, None for the default port or the port in the host name
+        :param encrypted: True to use HTTPS
+        :param timeout: Socket timeout in seconds, None for the default timeout
+        :return: The connection and the response. The response must be read completely and then the connection
+        must be returned with release(), or closed if there was an error
+        """
+        key = (host, port, encrypted)
+        con = self.__get_idle_connection(key)
+        if con is not None:
+            con.timeout = timeout
+            con.sock.settimeout(timeout)
+            try:
+                con.request(method, page, body, headers)
+                response = con.getresponse()
+                self.counters.connection_hits += 1
+                return con, response
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # the server closed the connection while it was idle
+                con.close()
+                self.counters.connection_reconnects += 1
+        self.counters.connection_misses += 1
+        if encrypted:
+            con = http.client.HTTPSConnection(host, port, timeout=timeout, context=self.get_ssl_context())
+        else:
+            con = http.client.HTTPConnection(host, port, timeout=timeout)
+        con.cyw_pool_key = key
+        try:
+            con.request(method, page, body, headers)
+            return con, con.getresponse()
+        except:
+            con.close()
+            raise
+
+    def release(self, con, response):
+        """Return a connection after the response was read, so that it can be used for the next request
+        """
+        if response.will_close or con.sock is None:
+            con.close()
+            return
+        with self.__lock:
+            idle = self.__idle.setdefault(con.cyw_pool_key, [])
+            idle.append([con, time.monotonic()])
+            while len(idle) > self.max_idle_connections:
+                idle.pop(0)[0].close()
+
+    def close_all(self):
+        with self.__lock:
+            for idle in self.__idle.values():
+                for con, released_time in idle:
+                    con.close()
+            self.__idle = {}
 
 
 # main class used for communication
@@ -342,6 +1124,7 @@ class CywInterface:
             if l.use_websocket:
                 if l.websocket_state == l.constants.ws_state_running:
                     l.websocket_state = l.constants.ws_state_set_listen_to_networks
+                    l.master_wakeup.set()  # the master thread sends the new network names
             else:
                 # if service is already running then stop the download request so that new networks can be loaded
                 self.send_cancel_request()
@@ -372,9 +1155,26 @@ class CywInterface:
                     l.logger.debug('WebSocket: Long polling cancel request sent')
                     l.websocket_state = l.constants.ws_state_not_connected
                     l.set_use_websocket = True
-                    while not l.to_master_for_cloud_queue.empty():
+                    while not l.to_master_for_cloud_control_queue.empty():
                         time.sleep(0.1)    # wait for message to be sent before setting use_websocket to true
             l.use_websocket = use_websocket
+            self.notify_threads()
+
+    def set_use_test_server(self, use_test_server, server_name=None):
+        """Connect to a local test server instead of www.controlyourway.com, see CywTestServer_p3.py. This can only
+        be changed when the service is not started. Encryption is not supported by the test server
+        :param use_test_server: True or False
+        :param server_name: Host and port of the test server, for example localhost:60061
+        :return: 0 if successful, 10 if failed
+        """
+        l = self.__locals
+        if l.cyw_state != l.constants.state_request_credentials:
+            l.logger.error('Test server cannot be set after service has started')
+            return '10'
+        l.constants.use_test_server = use_test_server
+        if server_name is not None:
+            l.constants.test_server_name = server_name
+        return '0'
 
     def get_use_websocket(self):
         """Return the true if websocket is enabled
@@ -415,6 +1215,147 @@ class CywInterface:
         """
         return self.__locals.download_timeout
 
+    def set_send_window(self, send_window):
+        """Set the number of uploads that can be sent before the response of the first one was received. With more
+        than one upload waiting for a response the throughput is not limited to one upload per round trip to the
+        server. Must be set before start() is called, start() creates one upload thread per upload for long polling
+        :param send_window: Number of uploads, 1 (default) waits for the response of every upload
+        """
+        self.__locals.master_vars.send_window = max(1, int(send_window))
+
+    def get_send_window(self):
+        return self.__locals.master_vars.send_window
+
+    def set_max_packet_size(self, size):
+        """Set the maximum number of bytes of data sent to the server in one upload. Messages are never split, a
+        message that is larger than this is sent in an upload of its own
+        :param size: Size in bytes (default: 100000)
+        """
+        self.__locals.max_packet_size = max(1, int(size))
+
+    def get_max_packet_size(self):
+        return self.__locals.max_packet_size
+
+    def set_max_messages_per_packet(self, max_messages):
+        """Set the maximum number of messages sent to the server in one upload
+        :param max_messages: Number of messages (default: 1000)
+        """
+        self.__locals.max_messages_per_packet = max(1, int(max_messages))
+
+    def get_max_messages_per_packet(self):
+        return self.__locals.max_messages_per_packet
+
+    def set_batch_lookahead_size(self, size):
+        """Set how far ahead in the queue messages are grouped when an upload is assembled. A message that goes to
+        the same networks and session IDs with the same data type as a message at most size messages before it
+        is sent together with it under one header, even if messages to other destinations were queued in between.
+        The order of the messages to one destination does not change. This does not limit the number of messages
+        in an upload, see set_max_messages_per_packet
+        :param size: Number of messages (default: 64), 1 only groups messages that are next to each other
+        """
+        self.__locals.batch_lookahead_size = max(1, int(size))
+
+    def get_batch_lookahead_size(self):
+        return self.__locals.batch_lookahead_size
+
+    def set_lane_weights(self, control_lane_weight, data_lane_weight):
+        """Data waiting to be uploaded is kept in two lanes. The control lane holds cancel requests, discovery
+        messages, data sent with CreateSendData.priority set to True and data not larger than the interactive
+        message size, the data lane holds all other data. When both lanes have data waiting, the control lane gets
+        control_lane_weight uploads for every data_lane_weight uploads of the data lane
+        :param control_lane_weight: Weight of the control lane (default: 4)
+        :param data_lane_weight: Weight of the data lane (default: 1)
+        """
+        self.__locals.control_lane_weight = max(1, int(control_lane_weight))
+        self.__locals.data_lane_weight = max(1, int(data_lane_weight))
+
+    def get_lane_weights(self):
+        return self.__locals.control_lane_weight, self.__locals.data_lane_weight
+
+    def set_interactive_message_size(self, size):
+        """Send data of up to this size in the control lane, ahead of larger data, see set_lane_weights. The order
+        of data sent in different lanes is not kept, do not use this when the data is one stream of bytes
+        :param size: Size in bytes after encoding, 0 (default) only sends priority data in the control lane
+        """
+        self.__locals.interactive_message_size = max(0, int(size))
+
+    def get_interactive_message_size(self):
+        return self.__locals.interactive_message_size
+
+    def set_max_send_buffer_size(self, size):
+        """Set the maximum number of bytes of data waiting in the send buffer to be uploaded. What send_data does
+        when the send buffer is full is set with set_send_buffer_overflow_policy
+        :param size: Size in bytes, 0 (default) for no limit
+        """
+        self.__locals.max_send_buffer_size = max(0, int(size))
+
+    def get_max_send_buffer_size(self):
+        return self.__locals.max_send_buffer_size
+
+    def set_send_buffer_overflow_policy(self, policy, block_timeout=None):
+        """Select what send_data does when the data does not fit in the send buffer
+        :param policy: 'reject' (default): send_data returns error code 30 and the data is not sent,
+        'drop_oldest': the oldest data in the send buffer is discarded to make space,
+        'block': send_data waits until there is space, send_data called from a callback of this library does not
+        wait and returns error code 30 if there is no space
+        :param block_timeout: Seconds the 'block' policy waits before returning error code 30, None keeps the
+        current value (default: 10)
+        :return: 0 if successful, 1 if the policy is unknown
+        """
+        l = self.__locals
+        if policy not in (l.constants.send_buffer_block, l.constants.send_buffer_drop_oldest,
+                          l.constants.send_buffer_reject):
+            l.logger.error('Unknown send buffer overflow policy: %s', policy)
+            return '1'
+        l.send_buffer_policy = policy
+        if block_timeout is not None:
+            l.send_buffer_block_timeout = block_timeout
+        return '0'
+
+    def get_send_buffer_overflow_policy(self):
+        return self.__locals.send_buffer_policy
+
+    def set_send_buffer_watermarks(self, high_watermark, low_watermark):
+        """Set when the high and low watermark callbacks are called. The high watermark callback is called when the
+        send buffer holds high_watermark bytes or more, after that the low watermark callback is called once the send
+        buffer holds low_watermark bytes or less
+        :param high_watermark: Bytes, 0 disables the callbacks
+        :param low_watermark: Bytes, must be less than high_watermark
+        """
+        l = self.__locals
+        l.send_buffer_high_watermark = max(0, int(high_watermark))
+        l.send_buffer_low_watermark = min(max(0, int(low_watermark)), max(0, l.send_buffer_high_watermark - 1))
+        self.check_send_buffer_watermarks()
+
+    def get_send_buffer_watermarks(self):
+        return self.__locals.send_buffer_high_watermark, self.__locals.send_buffer_low_watermark
+
+    def set_spool_directory(self, directory, max_size=67108864, segment_size=1048576):
+        """Store data waiting to be uploaded in files in a directory instead of in memory. Data that was not
+        acknowledged by the server is sent when the service is started again, also after the application was
+        restarted. Can only be set before the service is started
+        :param directory: Directory for the spool files, empty string to keep data in memory (default)
+        :param max_size: Maximum size in bytes of all the spool files, send_data returns error code 30 when full
+        :param segment_size: Size in bytes of one spool file, files are deleted once all their data was sent
+        :return: 0 if successful, 10 if the service was already started
+        """
+        l = self.__locals
+        if l.cyw_state != l.constants.state_request_credentials or l.master_thread_running:
+            l.logger.error('Spool directory cannot be set after service has started')
+            return '10'
+        if l.spool is not None:
+            l.spool.close()
+            l.spool = None
+        if directory != '':
+            l.spool = CywSpool(directory, max_size, segment_size, l.master_wakeup)
+            l.logger.debug('Spool directory set to %s, %d messages waiting', directory, l.spool.get_size())
+        return '0'
+
+    def get_spool_directory(self):
+        if self.__locals.spool is None:
+            return ''
+        return self.__locals.spool.directory
+
     def get_discoverable(self):
         """Return true if the discoverable state is set
         :return: Discoverable state
@@ -463,9 +1404,35 @@ class CywInterface:
     def get_counters(self):
         """Return the upload and download counters. These counters get incremented each time an upload or download
         is done
-        :return: counters variable containing counters.upload and counters.download
+        :return: counters variable containing counters.upload and counters.download, and for long polling
+        connections counters.connection_hits (request sent on a kept alive connection), counters.connection_misses
+        (new connection made) and counters.connection_reconnects (kept alive connection closed by the server).
+        The size of the uploads is in counters.batches (uploads with data), counters.batch_bytes and
+        counters.batch_messages (totals of all uploads), counters.batch_bytes_max and counters.batch_messages_max
+        (largest upload). counters.send_buffer_dropped and counters.send_buffer_rejected count the messages lost
+        because the send buffer was full. counters.control_lane and counters.data_lane have the depth and
+        depth_bytes (messages waiting), messages (messages sent), wait_time_total and wait_time_max (seconds the
+        sent messages waited) of each lane, see set_lane_weights
+        """
+        l = self.__locals
+        l.counters.control_lane.depth = l.to_master_for_cloud_control_queue.get_size()
+        l.counters.control_lane.depth_bytes = l.to_master_for_cloud_control_queue.get_bytes()
+        data_queue = l.to_master_for_cloud_queue if l.spool is None else l.spool
+        l.counters.data_lane.depth = data_queue.get_size()
+        l.counters.data_lane.depth_bytes = data_queue.get_bytes()
+        return l.counters
+
+    def set_max_receive_buffer_size(self, size):
+        """Set the maximum size of a message received from the server. Data of a message that is larger than
+        this is discarded
+        :param size: Size in bytes
         """
-        return self.__locals.counters
+        l = self.__locals
+        l.websocket_decoder.max_buffer_size = size
+        l.download_decoder.max_buffer_size = size
+
+    def get_max_receive_buffer_size(self):
+        return self.__locals.websocket_decoder.max_buffer_size
 
     def set_data_received_callback(self, cb):
         """Set the callback function which is called when data is received
@@ -473,6 +1440,21 @@ class CywInterface:
         """
         self.__locals.data_received_callback = cb
 
+    def set_receive_bytes(self, receive_bytes):
+        """Select the type of the data passed to the data received callback
+        :param receive_bytes: True: the data is passed as bytes, False (default): the data is passed as a string,
+        see set_string_encoding
+        """
+        self.__locals.receive_bytes = receive_bytes
+
+    def set_string_encoding(self, encoding):
+        """Select how string data is converted to the bytes that are sent, and how received data is converted to a
+        string for the data received callback
+        :param encoding: 'latin-1' (default): every character is one byte, any byte value is received without loss.
+        'utf-8': for text with characters above 255, bytes that are not valid UTF-8 are received as U+FFFD
+        """
+        self.__locals.string_encoding = encoding
+
     def set_connection_status_callback(self, cb):
         """Set the callback function which is called when the connection status changed.
         :param cb: callback function name
@@ -485,6 +1467,20 @@ class CywInterface:
         """
         self.__locals.error_callback = cb
 
+    def set_high_watermark_callback(self, cb):
+        """Set the callback function which is called when the send buffer reaches the high watermark, see
+        set_send_buffer_watermarks. Producers can stop sending data until the low watermark callback is called
+        :param cb: callback function name, called with the number of bytes in the send buffer
+        """
+        self.__locals.high_watermark_callback = cb
+
+    def set_low_watermark_callback(self, cb):
+        """Set the callback function which is called when the send buffer drops to the low watermark after the
+        high watermark was reached
+        :param cb: callback function name, called with the number of bytes in the send buffer
+        """
+        self.__locals.low_watermark_callback = cb
+
     def start(self):
         """Start the service. This function must be called for communication with the server to start. The connection
         status callback will have the result if the connection was successful
@@ -498,12 +1494,17 @@ class CywInterface:
             l.logger.error('No password specified')
             return '8'
         l.closing_threads = False
+        if l.spool is not None:
+            l.spool.rewind()  # send the data again that was not acknowledged before the service was stopped
         # start master thread
         l.master_thread = threading.Thread(target=self.master_thread, args=[l.master_vars])
         l.master_thread.start()
-        # start upload thread
-        l.upload_thread = threading.Thread(target=self.upload_thread)
-        l.upload_thread.start()
+        # start upload threads, one for every long polling upload that can wait for a response
+        l.upload_threads = []
+        for i in range(l.master_vars.send_window):
+            upload_thread = threading.Thread(target=self.upload_thread)
+            upload_thread.start()
+            l.upload_threads.append(upload_thread)
         # start download thread
         l.download_thread = threading.Thread(target=self.download_thread)
         l.download_thread.start()
@@ -515,19 +1516,97 @@ class CywInterface:
     def send_data(self, send_data):
         """Function used for sending data to the cloud
         :param send_data: data structure with all the data to be sent. The data structure can be created
-        by calling CreateSendData()
-        :return: return 0 if successful, 6 if sendData.data is empty
+        by calling CreateSendData(). The data can be bytes or a string, a string is converted with the encoding
+        selected with set_string_encoding (latin-1 by default), the same conversion that is used for received data.
+        UnicodeEncodeError is raised if the string has characters the encoding cannot represent. Data with
+        send_data.priority set to True is sent ahead of other data, see set_lane_weights
+        :return: return 0 if successful, 6 if sendData.data is empty, 30 if the send buffer is full, see
+        set_max_send_buffer_size
         """
+        l = self.__locals
         upload_data = CreateSendData()
-        upload_data.data = self.tilde_encode_data(send_data.data)
+        data = send_data.data
+        if isinstance(data, str):
+            data = data.encode(l.string_encoding)
+        upload_data.data = self.tilde_encode_data(bytes(data))
         upload_data.to_session_ids = send_data.to_session_ids
         for network in send_data.to_networks:
             upload_data.to_networks.append(self.tilde_encode_data(network))
         upload_data.data_type = self.tilde_encode_data(send_data.data_type)
-        upload_data.packet_type = self.__locals.constants.data_packet
-        self.__locals.to_master_for_cloud_queue.put(upload_data)
+        upload_data.packet_type = l.constants.data_packet
+        upload_data.queued_time = time.monotonic()
+        if send_data.priority or 0 < len(upload_data.data) <= l.interactive_message_size:
+            # control lane, never limited or spooled
+            l.to_master_for_cloud_control_queue.put(upload_data)
+        elif l.spool is not None:
+            if not l.spool.put(upload_data):
+                l.counters.send_buffer_rejected += 1
+                l.logger.debug('Spool full, data not sent')
+                return l.constants.error_send_buffer_full
+        elif l.max_send_buffer_size == 0:
+            l.to_master_for_cloud_queue.put(upload_data)
+        else:
+            timeout = 0
+            if l.send_buffer_policy == l.constants.send_buffer_block and \
+                    threading.current_thread() is not l.master_thread:
+                # the master thread empties the send buffer, it must not wait for itself
+                timeout = l.send_buffer_block_timeout
+            added, dropped = l.to_master_for_cloud_queue.put_limited(
+                upload_data, l.max_send_buffer_size, l.send_buffer_policy == l.constants.send_buffer_drop_oldest,
+                timeout, lambda packet: packet.packet_type == l.constants.data_packet)
+            if dropped:
+                l.counters.send_buffer_dropped += len(dropped)
+                l.logger.debug('Send buffer full, %d messages dropped', len(dropped))
+            if not added:
+                l.counters.send_buffer_rejected += 1
+                l.logger.debug('Send buffer full, data not sent')
+                return l.constants.error_send_buffer_full
+        self.check_send_buffer_watermarks()
         return '0'
 
+    def finish_spooled_upload(self, packet, delivered, wait_before_retry=False):
+        """This function must never be called directly by user. Acknowledge the spooled packets of an upload that
+        was received by the server, or read them from the spool again if the upload was lost
+        :param packet: The upload
+        :param delivered: True if the server received the upload
+        :param wait_before_retry: Wait before the spooled data is sent again
+        """
+        l = self.__locals
+        if l.spool is None or not packet.spooled_packets:
+            return
+        if delivered:
+            l.spool.ack(packet.spooled_packets)
+        else:
+            l.spool.rewind()
+            if wait_before_retry:
+                l.master_vars.timers.start('spool_retry', l.constants.wait_before_retry_timeout)
+
+    def check_send_buffer_watermarks(self):
+        """This function must never be called directly by user. Call the high or low watermark callback when the
+        amount of data in the send buffer crossed a watermark
+        """
+        l = self.__locals
+        if l.send_buffer_high_watermark == 0 and not l.send_buffer_above_high_watermark:
+            return
+        # the amount is read and the callback is called under the lock, so a state change is never decided from an
+        # amount that another thread changed in the meantime and the callbacks are called in the order of the state
+        # changes. The amount is read again after a callback, it could have crossed the other watermark meanwhile
+        with l.send_buffer_watermark_lock:
+            while True:
+                buffered_bytes = self.get_buffered_amount()
+                if not l.send_buffer_above_high_watermark:
+                    if not 0 < l.send_buffer_high_watermark <= buffered_bytes:
+                        break
+                    l.send_buffer_above_high_watermark = True
+                    callback = l.high_watermark_callback
+                elif buffered_bytes <= l.send_buffer_low_watermark or l.send_buffer_high_watermark == 0:
+                    l.send_buffer_above_high_watermark = False
+                    callback = l.low_watermark_callback
+                else:
+                    break
+                if callback is not None:
+                    callback(buffered_bytes)
+
     @staticmethod
     def test_ip_address(ip):
         """Check if an IP address is valid
@@ -549,38 +1628,22 @@ class CywInterface:
         return calendar.timegm(time.gmtime())
 
     @staticmethod
-    def check_if_data_can_be_added(packet1, packet2):
-        """Compare two upload data packets. If they are the same then their data can be concatenated
-        :param packet1: First packet used in comparison
-        :param packet2: Second packet used in comparison
-        :return: True if packets are the same, otherwise False
-        """
-        the_same = True
-        if packet1.data_type != packet2.data_type:
-            the_same = False
-        if packet1.packet_type != packet2.packet_type:
-            the_same = False
-        if len(packet1.to_networks) != len(packet2.to_networks):
-            the_same = False
-        if len(packet1.to_session_ids) != len(packet2.to_session_ids):
-            the_same = False
-        if the_same:
-            # check if the individual to networks and session ids are the same
-            for i in range(0, len(packet1.to_networks)):
-                if packet1.to_networks[i] != packet2.to_networks[i]:
-                    the_same = False
-            for i in range(0, len(packet1.to_session_ids)):
-                if packet1.to_session_ids[i] != packet2.to_session_ids[i]:
-                    the_same = False
-        return the_same
+    def get_destination_key(packet):
+        """Return a key that is the same for upload data packets of which the data can be concatenated
+        :param packet: Upload data packet
+        :return: Tuple of data type, networks and session IDs
+        """
+        return packet.data_type, tuple(packet.to_networks), tuple(packet.to_session_ids)
 
     @staticmethod
     def bracket_encode(data):
         """Build a string where all visible ASCII characters will be shown normally and non visible ASCII
         characters will be shown between square brackets. An opening square bracket will be [[
-        :param d: The data that must be bracket encoded
+        :param d: The data that must be bracket encoded, a string or bytes
         :return:
         """
+        if not isinstance(data, str):
+            data = bytes(data).decode('latin-1')
         text = ""
         for i in range(0, len(data)):
             val = ord(data[i])
@@ -603,22 +1666,31 @@ class CywInterface:
         l.logger.info('Master thread started')
         while l.master_thread_running:
             something_happened = False
+            # cleared before the queues and states are checked, anything that happens after this wakes the thread
+            l.master_wakeup.clear()
+            for timer in m.timers.update():
+                if timer[0] == 'upload':
+                    something_happened = True
+                    in_flight = m.packets_in_flight.pop(timer[1], None)
+                    if in_flight is not None:
+                        self.finish_spooled_upload(in_flight.packet, False, True)
+                    l.logger.error('Waiting for upload response timed out (' + str(timer[1]) + ')')
             if m.waiting_for_response:
-                if m.wait_before_retry < self.get_epoch_time():
+                if not m.timers.is_running('retry'):
                     something_happened = True
                     m.waiting_for_response = False
                     l.logger.error('Waiting for response timed out')
             else:
                 if l.cyw_state == l.constants.state_request_credentials and not l.closing_threads:
                     # check if enough time elapsed between retries to not swamp the server
-                    if m.wait_before_retry < self.get_epoch_time():
+                    if not m.timers.is_running('retry'):
                         something_happened = True
                         if self.connected:
                             # connection failed - call connection callback
                             self.connected = False
                             if l.connection_status_callback is not None:
                                 l.connection_status_callback(False)
-                        m.wait_before_retry = self.get_epoch_time() + l.constants.wait_before_retry_timeout
+                        m.timers.start('retry', l.constants.wait_before_retry_timeout)
                         m.waiting_for_response = True
                         send_packet = CywNewInstance()
                         if l.constants.use_test_server:
@@ -629,30 +1701,32 @@ class CywInterface:
                             send_packet.url_ssl = 'www.controlyourway.com'
                         send_packet.page = '/GetCredentials'
                         cyw_dict = CreateCywDictionary()
-                        cyw_dict.keys.append('p')   # protocol number
-                        cyw_dict.values.append('1')
-                        cyw_dict.keys.append('u')   # username
-                        cyw_dict.values.append(l.user_name)
-                        cyw_dict.keys.append('ps')  # network password
-                        cyw_dict.values.append(l.network_password)
-                        cyw_dict.keys.append('ec')  # request error code descriptions
-                        cyw_dict.values.append('1')
+                        cyw_dict.add('p', '1')   # protocol number
+                        cyw_dict.add('u', l.user_name)   # username
+                        cyw_dict.add('ps', l.network_password)  # network password
+                        cyw_dict.add('ec', '1')  # request error code descriptions
                         send_packet.post_data = CywInterface.encode_cyw_protocol(cyw_dict)
                         send_packet.packet_type = l.constants.request_credentials
+                        send_packet.upload_counter = None
                         l.to_cloud_queue.put(send_packet)
                         l.logger.debug('Request credentials')
                         l.networks_updated = False
                 elif l.cyw_state == l.constants.state_running:
                     if l.use_websocket:
                         if l.websocket_state == l.constants.ws_state_connected_not_auth:
+                            # packets sent on a previous connection will not be acknowledged
+                            for upload_counter, in_flight in m.packets_in_flight.items():
+                                m.timers.stop(('upload', upload_counter))
+                                self.finish_spooled_upload(in_flight.packet, False)
+                            m.packets_in_flight.clear()
                             l.websocket.send(l.auth_params + l.constants.terminating_string)
                             l.websocket_state = l.constants.ws_state_connected_auth_sent
-                            m.wait_before_retry = self.get_epoch_time() +  + l.constants.wait_before_retry_timeout
+                            m.timers.start('retry', l.constants.wait_before_retry_timeout)
                             m.waiting_for_response = True
                             something_happened = True
                             l.logger.debug('WebSocket: Send connection auth message')
                         elif l.websocket_state == l.constants.ws_state_set_listen_to_networks:
-                            m.wait_before_retry = self.get_epoch_time() +  + l.constants.wait_before_retry_timeout
+                            m.timers.start('retry', l.constants.wait_before_retry_timeout)
                             m.waiting_for_response = True
                             something_happened = True
                             l.websocket_state = l.constants.ws_state_set_listen_to_networks_sent
@@ -663,94 +1737,147 @@ class CywInterface:
                             l.websocket.send(network_data)
                             self.set_new_websocket_keep_alive_timeout(l.constants.websocket_keep_alive_timeout)
                             l.logger.debug('WebSocket: Set network names')
-                    if not m.last_packet_sent and m.send_packet is not None:
-                        # try again with packet that failed previously
-                        l.to_cloud_queue.put(m.send_packet)
-                        m.waiting_for_response = True
-                        m.wait_before_retry = self.get_epoch_time() + l.constants.wait_before_retry_timeout
-                        l.logger.debug('Try to send packet again')
-                    # check if there is new data to send
-                    elif not l.to_master_for_cloud_queue.empty():
-                        add_id = True    # id must only be added once
-                        send_str = ''
+                    # check if there is new data to send and the send window is not full
+                    control_ready = not l.to_master_for_cloud_control_queue.empty()
+                    if l.spool is None:
+                        data_ready = not l.to_master_for_cloud_queue.empty()
+                    else:
+                        # spooled data is sent again after a delay when an upload failed
+                        data_ready = not l.spool.empty() and not m.timers.is_running('spool_retry')
+                    if not m.waiting_for_response and len(m.packets_in_flight) < m.send_window and \
+                            (control_ready or data_ready):
+                        something_happened = True
+                        # when both lanes have packets waiting the control lane gets control_lane_weight uploads
+                        # for every data_lane_weight uploads of the data lane
+                        use_control_lane = control_ready
+                        if control_ready and data_ready:
+                            m.control_lane_credit += l.control_lane_weight
+                            m.data_lane_credit += l.data_lane_weight
+                            use_control_lane = m.control_lane_credit >= m.data_lane_credit
+                            if use_control_lane:
+                                m.control_lane_credit -= l.control_lane_weight + l.data_lane_weight
+                            else:
+                                m.data_lane_credit -= l.control_lane_weight + l.data_lane_weight
+                        if use_control_lane:
+                            send_queue = l.to_master_for_cloud_control_queue
+                            lane_counters = l.counters.control_lane
+                        else:
+                            send_queue = l.to_master_for_cloud_queue if l.spool is None else l.spool
+                            lane_counters = l.counters.data_lane
+                        # take as many packets from the queue as fit in one upload so that packets to the same
+                        # destination can be grouped even when they are not next to each other in the queue. packets
+                        # of the window that are not sent are pushed back to the front of the queue
+                        window = send_queue.drain(l.max_packet_size, l.max_messages_per_packet)
+                    else:
+                        window = []
+                    if window:  # a lane that was not empty could have been emptied by an acknowledgement
+                        packets_sent = 0
+                        batch_bytes = 0  # bytes added to the upload so far
+                        batch_messages = 0  # messages added to the upload so far
                         to_cloud_packet = CywNewInstance()
                         to_cloud_packet.packet_type = l.constants.data_packet
                         to_cloud_packet.url = l.upload_url
                         to_cloud_packet.url_ssl = l.upload_ssl_url
                         to_cloud_packet.page = '/Upload'
-                        to_cloud_packet.post_data = ''
-                        while not l.to_master_for_cloud_queue.empty() and len(send_str) < l.constants.max_packet_size:
-                            if not add_id:
-                                # this is not the first message added. check if the next message in the queue is the
-                                # same type of message, only one message type is allowed per upload
-                                popped_packet = l.to_master_for_cloud_queue.get()
-                                if popped_packet is None:
-                                    break
-                                l.to_master_for_cloud_queue.unshift(popped_packet)
-                                if m.send_packet.packet_type != popped_packet.packet_type:
-                                    break
-                            m.send_packet = l.to_master_for_cloud_queue.get()
-                            if m.send_packet is not None:
-                                if m.send_packet.packet_type == l.constants.data_packet:
-                                    if add_id:
-                                        add_id = False
-                                        if not l.use_websocket:
-                                            to_cloud_packet.post_data += l.upload_params
+                        post_parts = []  # the upload is built from bytes objects which are joined once
+                        if window[0].packet_type == l.constants.cancel_request:
+                            m.send_packet = window[0]
+                            packets_sent = 1
+                            to_cloud_packet.packet_type = l.constants.cancel_request
+                            post_parts = [m.send_packet.data.encode()]
+                            to_cloud_packet.page = '/CancelDownload'
+                        else:
+                            if not l.use_websocket:
+                                post_parts.append(l.upload_params.encode())
+                                batch_bytes += len(post_parts[0])
+                            # [header parts, packets] in the order the groups were started
+                            groups = []
+                            # destination -> group and window index of its last packet, a packet is added to the
+                            # group of its destination when at most batch_lookahead_size - 1 packets are in between
+                            open_groups = {}
+                            for index, popped_packet in enumerate(window):
+                                if popped_packet.packet_type != l.constants.data_packet:
+                                    break  # only one message type is allowed per upload, packets after it must wait
+                                destination = CywInterface.get_destination_key(popped_packet)
+                                message_bytes = len(popped_packet.data)
+                                group, last_index = open_groups.get(destination, (None, 0))
+                                if group is not None and index - last_index > l.batch_lookahead_size:
+                                    group = None  # too far apart, the packet starts a new group with its own header
+                                if group is None:
+                                    header_parts = []
                                     # add networks
-                                    for i in range(len(m.send_packet.to_networks)):
-                                        if m.send_packet.to_networks[i] != '':
-                                            to_cloud_packet.post_data += '~n=' + m.send_packet.to_networks[i]
+                                    for i in range(len(popped_packet.to_networks)):
+                                        if popped_packet.to_networks[i] != '':
+                                            header_parts.append(('~n=' + popped_packet.to_networks[i]).encode())
                                     # add session IDs
-                                    for i in range(len(m.send_packet.to_session_ids)):
-                                        if m.send_packet.to_session_ids[i] != '':
-                                            to_cloud_packet.post_data += '~s=' + m.send_packet.to_session_ids[i]
+                                    for i in range(len(popped_packet.to_session_ids)):
+                                        if popped_packet.to_session_ids[i] != '':
+                                            header_parts.append(('~s=' + popped_packet.to_session_ids[i]).encode())
                                     # add data type if present
-                                    if m.send_packet.data_type != '':
-                                        to_cloud_packet.post_data += '~dt=' + m.send_packet.data_type
+                                    if popped_packet.data_type != '':
+                                        header_parts.append(('~dt=' + popped_packet.data_type).encode())
                                     # add data - must be the last parameter per message
-                                    to_cloud_packet.post_data += '~d=' + m.send_packet.data
-                                    # see if more packets can be added
-                                    while not l.to_master_for_cloud_queue.empty() and len(send_str) < l.constants.max_packet_size:
-                                        # make sure that data is going to the same URL before dequeueing it
-                                        popped_packet = l.to_master_for_cloud_queue.get()
-                                        if popped_packet is not None:
-                                            if CywInterface.check_if_data_can_be_added(m.send_packet, popped_packet):
-                                                # add the data because the data is going to the same devices
-                                                to_cloud_packet.post_data += popped_packet.data
-                                            else:
-                                                # push back to front of queue because parameters are different
-                                                l.to_master_for_cloud_queue.unshift(popped_packet)
-                                                break
-                                        else:
-                                            break
-                                elif m.send_packet.packet_type == l.constants.cancel_request:
-                                    to_cloud_packet = CywNewInstance()
-                                    to_cloud_packet.packet_type = l.constants.cancel_request
-                                    to_cloud_packet.url = l.upload_url
-                                    to_cloud_packet.url_ssl = l.upload_ssl_url
-                                    to_cloud_packet.post_data = m.send_packet.data
-                                    to_cloud_packet.page = '/CancelDownload'
-                        m.retry_count = 0
+                                    header_parts.append(b'~d=')
+                                    message_bytes += sum(len(part) for part in header_parts)
+                                    group = [header_parts, []]
+                                if batch_messages > 0 and (batch_messages >= l.max_messages_per_packet or
+                                                           batch_bytes + message_bytes > l.max_packet_size):
+                                    # the upload is full, the rest is sent in the next upload. a message is never
+                                    # split so the first message is always added even if it is larger than the limit
+                                    break
+                                if not group[1]:
+                                    groups.append(group)
+                                open_groups[destination] = (group, index)
+                                group[1].append(popped_packet)
+                                batch_bytes += message_bytes
+                                batch_messages += 1
+                            for header_parts, group_packets in groups:
+                                post_parts.extend(header_parts)
+                                for popped_packet in group_packets:
+                                    post_parts.append(popped_packet.data)
+                            # the messages that were added are the first batch_messages packets in the window
+                            packets_sent = batch_messages
+                            m.send_packet = window[packets_sent - 1]
+                        send_queue.unshift(*window[packets_sent:])
+                        now = time.monotonic()
+                        for packet in window[:packets_sent]:
+                            wait_time = now - packet.queued_time
+                            lane_counters.messages += 1
+                            lane_counters.wait_time_total += wait_time
+                            lane_counters.wait_time_max = max(lane_counters.wait_time_max, wait_time)
+                        # packets read from the spool are acknowledged when the server received the upload
+                        to_cloud_packet.spooled_packets = []
+                        if send_queue is l.spool:
+                            to_cloud_packet.spooled_packets = window[:packets_sent]
+                        self.check_send_buffer_watermarks()
+                        if batch_messages > 0:
+                            l.counters.batches += 1
+                            l.counters.batch_bytes += batch_bytes
+                            l.counters.batch_messages += batch_messages
+                            l.counters.batch_bytes_max = max(l.counters.batch_bytes_max, batch_bytes)
+                            l.counters.batch_messages_max = max(l.counters.batch_messages_max, batch_messages)
+                        to_cloud_packet.upload_counter = l.counters.upload
+                        # add counter, the WebSocket response to the upload contains it
+                        post_parts.append(('~z=' + str(l.counters.upload)).encode())
                         if l.use_websocket:
-                            to_cloud_packet.post_data += l.constants.terminating_string
-                        else:
-                            # add counter
-                            to_cloud_packet.post_data += '~z=' + str(l.counters.upload)
+                            post_parts.append(l.constants.terminating_bytes)
+                        to_cloud_packet.post_data = b''.join(post_parts)
                         if l.log_level == logging.DEBUG:
                             # log detailed data about the data that was sent
                             log_str = "Data sent: " \
                                       + CywInterface.bracket_encode(to_cloud_packet.post_data)
                             l.logger.debug(log_str)
                         if l.use_websocket:
-                            l.websocket.send(to_cloud_packet.post_data)
+                            # binary frame, the data can contain any byte and a text frame must be valid UTF-8
+                            l.websocket.send(to_cloud_packet.post_data, websocket.ABNF.OPCODE_BINARY)
                             self.set_new_websocket_keep_alive_timeout(l.constants.websocket_keep_alive_timeout)
                             l.logger.debug('WebSocket: Sending packet')
                         else:
                             l.to_cloud_queue.put(to_cloud_packet)
                             l.logger.debug('Long Polling: Sending packet')
+                        m.packets_in_flight[l.counters.upload] = InFlightPacket(to_cloud_packet, l.counters.upload)
+                        m.timers.start(('upload', l.counters.upload), l.constants.wait_before_retry_timeout)
                         l.counters.upload += 1
-                        m.waiting_for_response = True
-                        m.wait_before_retry = self.get_epoch_time() + l.constants.wait_before_retry_timeout
             # //////////////////////////////////////////////////////////////////////////////////////////////
             # process data received from web socket
             if not l.websocket_receive_queue.empty():
@@ -826,20 +1953,40 @@ class CywInterface:
                         if send_error:
                             if l.error_callback is not None:
                                 l.error_callback(ws_error_code)
-                        m.last_packet_sent = True
-                        m.waiting_for_response = False
+                        # the response contains the counter of the upload. A response without it is for the oldest
+                        # upload, the server answers the uploads in the order they were sent. A response to an upload
+                        # that is not in flight anymore, because it timed out, is ignored
+                        in_flight = None
+                        upload_counter = CywInterface.get_cyw_dictionary_single_value(wsdict, 'z')
+                        if upload_counter is None:
+                            if len(m.packets_in_flight) > 0:
+                                upload_counter, in_flight = m.packets_in_flight.popitem(last=False)
+                        else:
+                            try:
+                                upload_counter = int(upload_counter)
+                            except ValueError:
+                                upload_counter = None
+                            in_flight = m.packets_in_flight.pop(upload_counter, None)
+                            if in_flight is None:
+                                l.logger.debug('Response to an upload that is not in flight: ' + str(upload_counter))
+                        if in_flight is not None:
+                            m.timers.stop(('upload', upload_counter))
+                            # the data of an upload that failed because the session expired is sent again after
+                            # the next connection is made
+                            self.finish_spooled_upload(in_flight.packet, ws_error_code not in ('12', '20'),
+                                                       ws_error_code == '20')
                         self.set_new_websocket_keep_alive_timeout(l.constants.websocket_keep_alive_timeout)
                         l.keep_alive_sent = False
                     elif response_type_value == 'r':   # receive data
                         ws_rec_data = DownloadResponse()
                         l.logger.debug('Data received from server')
-                        for i_rec_data in range(1,  len(wsdict.keys)):
-                            if wsdict.keys[i_rec_data] == 'f':  # from session id
-                                ws_rec_data.from_who = int(wsdict.values[i_rec_data])
-                            elif wsdict.keys[i_rec_data] == 'dt':  # data type
-                                ws_rec_data.data_type = wsdict.values[i_rec_data]
-                            elif wsdict.keys[i_rec_data] == 'd':  # data
-                                ws_rec_data.data = wsdict.values[i_rec_data]
+                        for key, value in wsdict.items():
+                            if key == 'f':  # from session id
+                                ws_rec_data.from_who = int(value)
+                            elif key == 'dt':  # data type
+                                ws_rec_data.data_type = value
+                            elif key == 'd':  # data
+                                ws_rec_data.data = value
                                 l.from_from_cloud_to_master_queue.put(ws_rec_data)
                                 ws_rec_data = DownloadResponse()
                     elif response_type_value == 'k':
@@ -866,20 +2013,21 @@ class CywInterface:
                             if l.error_callback is not None:
                                 l.error_callback(ws_error_code)
             if l.use_websocket:
-                if (m.wait_before_retry < self.get_epoch_time()) and \
+                if not m.timers.is_running('retry') and \
                         (l.websocket_state == l.constants.ws_state_waiting_for_connection):
                     # connection has timed out, try again
                     something_happened = True
                     l.websocket_state = l.constants.ws_state_not_connected
                     m.waiting_for_response = False
-                if (m.wait_before_retry < self.get_epoch_time()) and \
+                    self.notify_threads()  # the WebSocket thread creates the new connection
+                if not m.timers.is_running('retry') and \
                         (l.websocket_state == l.constants.ws_state_connected_auth_sent):
                     # authorisation sent but has timed out, send it again
                     something_happened = True
                     l.websocket_state = l.constants.ws_state_connected_not_auth
                     m.waiting_for_response = False
                     l.logger.debug('WebSocket: Auth timed out, trying again')
-                if (m.wait_before_retry < self.get_epoch_time()) and \
+                if not m.timers.is_running('retry') and \
                         (l.websocket_state == l.constants.ws_state_set_listen_to_networks_sent):
                     # no response when setting networks, try again
                     something_happened = True
@@ -907,10 +2055,13 @@ class CywInterface:
                 l.logger.debug('To cloud thread data received')
                 if d is not None:
                     something_happened = True
-                    m.waiting_for_response = False
                     cyw_dict = CywInterface.decode_cyw_protocol(d.response)
                     error_code = CywInterface.get_cyw_dictionary_single_value(cyw_dict, 'e')
+                    # the upload this is the response to, None if it timed out
+                    in_flight = m.packets_in_flight.pop(d.upload_counter, None)
+                    m.timers.stop(('upload', d.upload_counter))
                     if d.packet_type == l.constants.request_credentials:
+                        m.waiting_for_response = False
                         if error_code == '0':  # success
                             l.device_id = CywInterface.get_cyw_dictionary_single_value(cyw_dict, 'id')
                             urls = CywInterface.get_cyw_dictionary_values(cyw_dict, 'ip')
@@ -939,16 +2090,17 @@ class CywInterface:
                                     # store the error codes
                                     store_error_codes = False
                                     l.error_codes = CreateCywDictionary()
-                                    for ie in range(len(cyw_dict.keys)):
-                                        if cyw_dict.keys[ie] == '0':
+                                    for key, value in cyw_dict.items():
+                                        if key == '0':
                                             # this is the first error code
                                             store_error_codes = True
                                         if store_error_codes:
-                                            l.error_codes.keys.append(cyw_dict.keys[ie])
-                                            l.error_codes.values.append((cyw_dict.values[ie]))
+                                            l.error_codes.add(key, value)
                                     l.cyw_state = l.constants.state_running
                                     self.build_urls()
                                     l.download_thread_request = True  # download thread can start requesting
+                                    # wake the threads after the URLs were built, they use them right away
+                                    self.notify_threads()
                                     self.connected = True
                                     l.logger.debug('Got credentials from server')
                                     if l.connection_status_callback is not None:
@@ -964,6 +2116,9 @@ class CywInterface:
                             l.upload_thread_running = False
                             l.master_thread_running = False
                             l.websocket_thread_running = False
+                            for upload_thread in l.upload_threads:
+                                l.to_cloud_queue.put(None)  # wake the upload threads so that they can stop
+                            self.notify_threads()
                             if l.connection_status_callback is not None:
                                 l.connection_status_callback(False)
                             if l.error_callback is not None:
@@ -1009,17 +2164,23 @@ class CywInterface:
                             error_code = '3'  # invalid data received from server
                             retry_message = True
                             l.logger.debug('Invalid data received from server')
-                        if retry_message:
-                            if m.retry_count < m.max_retries:
-                                m.last_packet_sent = False
-                                m.send_packet = m.last_packet_uploaded
-                                m.retry_count += 1
-                                l.logger.debug('Retrying...')
+                        retrying = False
+                        if retry_message and in_flight is not None:
+                            if in_flight.retry_count < m.max_retries:
+                                retrying = True
+                                # send the same packet again, with the same upload counter
+                                in_flight.retry_count += 1
+                                m.timers.start(('upload', in_flight.upload_counter),
+                                               l.constants.wait_before_retry_timeout)
+                                m.packets_in_flight[in_flight.upload_counter] = in_flight
+                                l.to_cloud_queue.put(in_flight.packet)
+                                l.logger.debug('Retrying... (' + str(in_flight.upload_counter) + ')')
                             else:
-                                m.last_packet_sent = True
-                                l.logger.debug('Max retries reached')
+                                l.logger.debug('Max retries reached (' + str(in_flight.upload_counter) + ')')
                                 if l.error_callback is not None:
                                     l.error_callback(error_code)
+                        if in_flight is not None and not retrying:
+                            self.finish_spooled_upload(in_flight.packet, error_code not in ('12', '20'), True)
                         if send_error:
                             l.logger.debug('Send error')
                             if l.error_callback is not None:
@@ -1032,20 +2193,26 @@ class CywInterface:
                 if d is not None:
                     something_happened = True
                     if d.error_code == '0':  # no error - data was received
-                        if l.discoverable and d.data == '?' and d.data_type == 'Discovery':
+                        if l.discoverable and d.data == b'?' and d.data_type == 'Discovery':
                             # send discovery response
                             send_data = CreateSendData()
                             send_data.data_type = "Discovery Response"
-                            send_data.data = self.name
+                            send_data.data = self.name.encode(l.string_encoding, errors='replace')
                             send_data.to_session_ids.append(str(d.from_who))
+                            send_data.priority = True
                             self.send_data(send_data)
                             l.logger.debug('Discovery response sent')
                         else:
-                            d_mes = 'Data received: ' + d.data + ', Data type: ' + d.data_type
-                            d_mes += ', From: ' + str(d.from_who)
-                            l.logger.debug(d_mes)
+                            if l.log_level == logging.DEBUG:
+                                d_mes = 'Data received: ' + CywInterface.bracket_encode(d.data)
+                                d_mes += ', Data type: ' + d.data_type + ', From: ' + str(d.from_who)
+                                l.logger.debug(d_mes)
                             if l.data_received_callback is not None:
-                                l.data_received_callback(d.data, d.data_type, d.from_who)
+                                if l.receive_bytes:
+                                    l.data_received_callback(d.data, d.data_type, d.from_who)
+                                else:
+                                    l.data_received_callback(d.data.decode(l.string_encoding, errors='replace'),
+                                                             d.data_type, d.from_who)
                     elif d.error_code == '12':     # invalid session id
                         l.cyw_state = l.constants.state_request_credentials
                         l.logger.debug('Invalid session ID from FromCloud thread')
@@ -1057,7 +2224,10 @@ class CywInterface:
                         l.logger.debug('Download request timeout changed to: ' + str(l.download_timeout) + ' seconds')
 
             if not something_happened:
-                time.sleep(l.constants.thread_sleep_time)
+                # a watermark crossing that was missed is caught before going to sleep
+                self.check_send_buffer_watermarks()
+                # sleep until there is something to do or the next timer expires
+                l.master_wakeup.wait(m.timers.get_wait_time())
         l.master_thread_terminated = True
         l.logger.debug('Master thread terminated')
 
@@ -1070,32 +2240,33 @@ class CywInterface:
         l.upload_thread_terminated = False
         l.logger.debug('Upload thread started')
         while l.upload_thread_running:
-            if not l.to_cloud_queue.empty():
+            # wait until there is something to upload, None is put in the queue to stop the thread
+            packet = l.to_cloud_queue.get()
+            if packet is not None:
+                con = None
+                # the response is matched to the upload with these also when the request fails
+                upload_response = UploadResponse()
+                upload_response.upload_counter = packet.upload_counter
+                upload_response.packet_type = packet.packet_type
                 try:
-                    packet = l.to_cloud_queue.get()
-                    l.master_vars.last_packet_uploaded = packet
                     if l.use_encryption:
-                        where = packet.url_ssl
-                        if l.ssl_context_upload is None:
-                            l.ssl_context_upload = ssl.create_default_context()
-                        con = http.client.HTTPSConnection(where, 443, context=l.ssl_context_upload)
+                        con, response = l.connection_pool.request(packet.url_ssl, 443, True, None, 'POST',
+                                                                  packet.page, packet.post_data, l.headers)
                     else:
-                        where = packet.url
-                        con = http.client.HTTPConnection(where)
-                    upload_response = UploadResponse()
-                    con.request('POST', packet.page, packet.post_data, l.headers)
-                    response = con.getresponse()
+                        con, response = l.connection_pool.request(packet.url, None, False, None, 'POST',
+                                                                  packet.page, packet.post_data, l.headers)
                     l.logger.debug('Upload request sent')
-                    upload_response.packet_type = packet.packet_type
                     if response.status == 200:
                         upload_response.response = response.read()
                     else:
+                        response.read()
                         upload_response.response = '~e=20'  # Could not establish connection to website
+                    l.connection_pool.release(con, response)
                 except:
+                    if con is not None:
+                        con.close()
                     upload_response.response = '~e=20'  # Could not establish connection to website
                 l.from_to_cloud_to_master_queue.put(upload_response)
-            else:
-                time.sleep(self.__locals.constants.thread_sleep_time)
         l.upload_thread_terminated = True
         l.logger.debug('Upload thread terminated')
 
@@ -1108,27 +2279,23 @@ class CywInterface:
         l.download_thread_terminated = False
         l.restart_download = False
         l.last_download_successful = False
-        download_started_time = self.get_epoch_time()
+        download_started_time = time.monotonic()
+        download_overflows = l.download_decoder.overflows
+        download_errors = 0  # failed download requests in a row
         l.logger.debug('Download thread started')
         while l.download_thread_running:
             if l.use_websocket:
                 # this thread must not do anything if we use websocket
-                time.sleep(0.2)
+                with l.thread_condition:
+                    l.thread_condition.wait_for(lambda: not l.use_websocket or not l.download_thread_running)
             else:
                 wait_before_next_request = False
+                l.wait_before_next_request = False  # set when the server answered with an error
                 if l.cyw_state == l.constants.state_running:
-                    url = ''
                     previous_download_started_time = download_started_time
-                    download_started_time = self.get_epoch_time()
+                    download_started_time = time.monotonic()
+                    con = None
                     try:
-                        if l.use_encryption:
-                            url += l.download_ssl_url
-                            if l.ssl_context_download is None:
-                                l.ssl_context_download = ssl.create_default_context()
-                            con = http.client.HTTPSConnection(url, 443, context=l.ssl_context_download, timeout=l.download_timeout+30)
-                        else:
-                            url += l.download_url
-                            con = http.client.HTTPConnection(url, timeout=l.download_timeout+30)
                         post_data = l.auth_params
                         update_networks = False
                         if not l.networks_updated:
@@ -1147,25 +2314,44 @@ class CywInterface:
                         else:
                             l.logger.debug('New download request started (' + str(l.counters.download) + ')')
                         l.counters.download += 1
-                        con.request('POST', l.download_page, post_data, l.headers)
-                        response = con.getresponse()
+                        if l.use_encryption:
+                            con, response = l.connection_pool.request(l.download_ssl_url, 443, True,
+                                                                      l.download_timeout + 30, 'POST',
+                                                                      l.download_page, post_data, l.headers)
+                        else:
+                            con, response = l.connection_pool.request(l.download_url, None, False,
+                                                                      l.download_timeout + 30, 'POST',
+                                                                      l.download_page, post_data, l.headers)
                         l.logger.debug('Download response received')
-                        if response.status == 200:
-                            temp_resp = response.read()
-                            cyw_dict = CywInterface.decode_cyw_protocol(temp_resp)
+                        if response.status != 200:
+                            con.close()
+                            l.logger.debug('Download error - HTTP status ' + str(response.status))
+                            l.wait_before_next_request = True
+                        else:
+                            l.download_decoder.reset()
+                            while True:
+                                chunk = response.read(l.constants.receive_chunk_size)
+                                if not chunk:
+                                    break
+                                l.download_decoder.feed(chunk)
+                            l.connection_pool.release(con, response)
+                            if l.download_decoder.overflows != download_overflows:
+                                download_overflows = l.download_decoder.overflows
+                                l.logger.error('Download response larger than the receive buffer, data discarded')
+                            cyw_dict = l.download_decoder.finish()
                             error_code = CywInterface.get_cyw_dictionary_single_value(cyw_dict, 'e')
                             if error_code is None:
                                 l.wait_before_next_request = True
                             else:
                                 if error_code == '0':
                                     d = DownloadResponse()
-                                    for i in range(len(cyw_dict.keys)):
-                                        if cyw_dict.keys[i] == 'f':  # from session id
-                                            d.from_who = int(cyw_dict.values[i])
-                                        elif cyw_dict.keys[i] == 'dt':  # data type
-                                            d.data_type = cyw_dict.values[i]
-                                        elif cyw_dict.keys[i] == 'd':  # data
-                                            d.data = cyw_dict.values[i]
+                                    for key, value in cyw_dict.items():
+                                        if key == 'f':  # from session id
+                                            d.from_who = int(value)
+                                        elif key == 'dt':  # data type
+                                            d.data_type = value
+                                        elif key == 'd':  # data
+                                            d.data = value
                                             l.from_from_cloud_to_master_queue.put(d)
                                             d = DownloadResponse()
                                     l.last_download_successful = True
@@ -1200,6 +2386,7 @@ class CywInterface:
                                     if l.set_use_websocket:
                                         l.set_use_websocket = False
                                         l.use_websocket = True
+                                        self.notify_threads()
                                 elif error_code == '16':  # no data available - restart connection immediately
                                     l.last_download_successful = True
                                 elif error_code == '18':  # multiple download requests made with the same session ID
@@ -1208,7 +2395,7 @@ class CywInterface:
                                     # if the request is older than 5 seconds then this is what happened. Calculate the time
                                     # it took and make sure that the request time is shorter than this
                                     l.logger.debug('Multiple requests to same session ID')
-                                    current_time = self.get_epoch_time()
+                                    current_time = time.monotonic()
                                     if l.last_download_successful:
                                         delta_t = current_time - download_started_time
                                     else:
@@ -1239,12 +2426,30 @@ class CywInterface:
                                         l.from_from_cloud_to_master_queue.put(d)
                                     l.last_download_successful = True
                     except:
+                        if con is not None:
+                            con.close()
                         wait_before_next_request = True
                         l.last_download_successful = False
-                if wait_before_next_request:
-                    time.sleep(5)
-                else:
-                    time.sleep(0.1)
+                    if l.wait_before_next_request:
+                        wait_before_next_request = True
+                    if wait_before_next_request:
+                        download_errors += 1
+                    else:
+                        download_errors = 0
+                        if l.last_download_successful:
+                            continue  # start the next request immediately
+                with l.thread_condition:
+                    if wait_before_next_request and l.cyw_state == l.constants.state_running:
+                        # wait longer after every failed request so that a server with problems is not flooded
+                        wait_time = min(l.constants.download_error_wait_time * 2 ** min(download_errors - 1, 16),
+                                        l.constants.download_error_max_wait_time)
+                        l.logger.debug('Waiting %.1f seconds before the next download request', wait_time)
+                        l.thread_condition.wait_for(lambda: not l.download_thread_running, wait_time)
+                    elif l.cyw_state != l.constants.state_running:
+                        l.thread_condition.wait_for(lambda: l.cyw_state == l.constants.state_running or
+                                                    not l.download_thread_running)
+                    else:
+                        l.thread_condition.wait_for(lambda: not l.download_thread_running, 0.1)
         l.download_thread_terminated = True
         l.logger.debug('Download thread terminated')
 
@@ -1283,9 +2488,24 @@ class CywInterface:
                 l.closing_threads = True
             send_packet.data = post_str
             send_packet.packet_type = l.constants.cancel_request
-            l.to_master_for_cloud_queue.put(send_packet)
+            send_packet.queued_time = time.monotonic()
+            if terminate_session and l.spool is None:
+                # the session ends when the server receives this request, it is queued behind the data so that the
+                # data that is waiting is sent first. With a spool the data that was not sent is kept on disk
+                l.to_master_for_cloud_queue.put(send_packet)
+            else:
+                l.to_master_for_cloud_control_queue.put(send_packet)
             l.logger.debug('Download cancel request sent to server')
 
+    def notify_threads(self):
+        """This function must never be called directly by user. Wakes the threads that wait for a change of the
+        connection type or state
+        """
+        l = self.__locals
+        with l.thread_condition:
+            l.thread_condition.notify_all()
+        l.master_wakeup.set()
+
     def close_connection(self, clear_callbacks=False):
         """ Must be called when service is stopped. This will close all the connections and threads
         :param clear_callbacks: Set to true to clear all the callback. This is useful when this function
@@ -1299,6 +2519,7 @@ class CywInterface:
         l.closing_threads = True
         if l.download_thread_running:  #check if threads are running
             l.download_thread_running = False
+            self.notify_threads()
             if l.cyw_state == l.constants.state_running:
                 if l.use_websocket:
                     try:
@@ -1313,11 +2534,19 @@ class CywInterface:
                     l.logger.debug('Long polling: Close connection message sent')
             l.download_thread.join()
             l.upload_thread_running = False
-            l.upload_thread.join()
+            for upload_thread in l.upload_threads:
+                l.to_cloud_queue.put(None)  # wake the upload thread so that it can stop
+            for upload_thread in l.upload_threads:
+                upload_thread.join()
             l.websocket_thread_running = False
+            self.notify_threads()
             l.websocket_thread.join()
             l.master_thread_running = False
+            l.master_wakeup.set()
             l.master_thread.join()
+            l.connection_pool.close_all()
+            if l.spool is not None:
+                l.spool.flush()
             if self.connected:
                 self.connected = False
                 if l.connection_status_callback is not None:
@@ -1348,11 +2577,7 @@ class CywInterface:
         :param key: Key to look for in dictionary
         :return: An array of values that matched the key
         """
-        values = []
-        for i in range(len(cyw_dict.keys)):
-            if cyw_dict.keys[i] == key:
-                values.append(cyw_dict.values[i])
-        return values
+        return list(cyw_dict.get_values(key))
 
     @staticmethod
     def get_cyw_dictionary_single_value(cyw_dict, key):
@@ -1361,30 +2586,18 @@ class CywInterface:
         :param key: First key to look for in dictionary
         :return: The value of the first key that matches, otherwise None
         """
-        value = None
-        for i in range(len(cyw_dict.keys)):
-            if cyw_dict.keys[i] == key:
-                # found first key that matched
-                value = cyw_dict.values[i]
-                break
-        return value
+        return cyw_dict.get_single_value(key)
 
     @staticmethod
     def tilde_encode_data(data):
         """Tilde is the control character used by Control Your Way. This function will encode the tilde character
         and the character for ASCII 0
-        :param data: The data that must be encoded
-        :return: The encoded data
+        :param data: The data that must be encoded, a string or bytes
+        :return: The encoded data, the same type as data
         """
-        encoded = ''
-        for i in range(0, len(data)):
-            if data[i] == '~':
-                encoded += '~~'
-            elif ord(data[i]) == 0:
-                encoded += '~-'
-            else:
-                encoded += data[i]
-        return encoded
+        if isinstance(data, str):
+            return data.replace('~', '~~').replace('\x00', '~-')
+        return data.replace(b'~', b'~~').replace(b'\x00', b'~-')
 
     @staticmethod
     def encode_cyw_protocol(cyw_dict):
@@ -1392,87 +2605,69 @@ class CywInterface:
         :param cyw_dict: Input cyw dictionary
         :return: The output string
         """
-        encoded_data = ''
-        for i in range(0, len(cyw_dict.keys)):
-            encoded_data += '~' + cyw_dict.keys[i] + '=' + CywInterface.tilde_encode_data(cyw_dict.values[i])
-        return encoded_data
+        return ''.join(['~' + key + '=' + CywInterface.tilde_encode_data(value) for key, value in cyw_dict.items()])
 
     @staticmethod
-    def decode_cyw_protocol(rawdata):
+    def decode_cyw_protocol(rawdata, bytes_keys=()):
         """This function will decode the Control Your Way protocol where a tilde is used as a control character
-        :param rawdata: Raw data received from the server
+        :param rawdata: Raw data received from the server, a string or bytes
+        :param bytes_keys: Only used when rawdata is bytes. The values of these keys are left as bytes, all
+        other values are converted to strings (latin-1). The keys are always strings
         :return: Return a CYW dictionary with all the decoded data
         """
         cyw_dict = CreateCywDictionary()
-        state_key = 0
-        state_value = 1
-        state_control_char_in_value = 2
-        state = state_key
-        the_key = ''
-        the_value = ''
-        control_char = '~'
-        end_of_key = '='
-
-        # convert byte array to string
-        data_type = type(rawdata)
-        if data_type == str:
+        text = isinstance(rawdata, str)
+        if text:
             data = rawdata
+            control_char, end_of_key, escaped_tilde, escaped_zero, blanked = '~', '=', '~~', '~-', '\x01\x01'
+            zero = '\x00'
         else:
-            data = ''
-            for b in rawdata:
-                data += chr(b)
+            data = bytes(rawdata)
+            control_char, end_of_key, escaped_tilde, escaped_zero, blanked = b'~', b'=', b'~~', b'~-', b'\x01\x01'
+            zero = b'\x00'
 
-        if data[0] != '~':
+        if data[:1] != control_char:
             return   # protocol problem
-        for i in range(1, len(data)):
-            c = data[i]
-            last_char = False
-            if i == len(data) - 1:
-                last_char = True
-            if state == state_key:
-                if last_char or c == control_char:
-                    return cyw_dict
-                if c == end_of_key:
-                    state = state_value
-                else:
-                    the_key += c
-            elif state == state_value:
-                if c == control_char:
-                    if last_char:
-                        return   # last character cannot be a control character
-                    else:
-                        state = state_control_char_in_value
-                else:
-                    the_value += c
-                    if last_char:
-                        cyw_dict.keys.append(the_key)
-                        cyw_dict.values.append(the_value)
-            elif state == state_control_char_in_value:
-                if c == control_char:
-                    # double tilde means a tilde was sent
-                    the_value += c
-                    state = state_value
-                    if last_char:
-                        cyw_dict.keys.append(the_key)
-                        cyw_dict.values.append(the_value)
-                elif c == '-':
-                    # this means a zero was sent in the string
-                    the_value += chr(0)
-                    state = state_value
-                    if last_char:
-                        cyw_dict.keys.append(the_key)
-                        cyw_dict.values.append(the_value)
-                else:
-                    if last_char:
-                        return   # last character cannot be a control character
-                    else:
-                        cyw_dict.keys.append(the_key)
-                        cyw_dict.values.append(the_value)
-                        the_key = ''
-                        the_value = ''
-                        the_key += c
-                        state = state_key
-        return cyw_dict
+        last = len(data) - 1
+        # copy of the data where the escape sequences are blanked out, so that a find for a tilde returns the
+        # next single tilde. The escape sequences have the same length so positions are the same in both copies
+        single_tildes = data.replace(escaped_tilde, blanked).replace(escaped_zero, blanked)
+        # the first character of a key is only checked at the start of the message, after that it is the character
+        # that followed a single tilde in the previous value
+        key_start = 1
+        check_from = 1
+        while True:
+            # key: runs up to the next '=', the message ends if a tilde or the end of the data is found first
+            equals_index = data.find(end_of_key, check_from)
+            if equals_index < 0 or equals_index == last:
+                return cyw_dict
+            tilde_index = data.find(control_char, check_from, equals_index)
+            if tilde_index >= 0:
+                return cyw_dict
+            the_key = data[key_start:equals_index]
+            if not text:
+                the_key = the_key.decode('latin-1')
+            # value: runs up to the first single tilde, a double tilde is a tilde and ~- is a zero
+            value_start = equals_index + 1
+            value_end = single_tildes.find(control_char, value_start)
+            if value_end < 0:
+                value_end = last + 1
+            if value_end == last:
+                return   # last character cannot be a control character
+            the_value = data[value_start:value_end]
+            if control_char in the_value:
+                the_value = control_char.join([part.replace(escaped_zero, zero)
+                                               for part in the_value.split(escaped_tilde)])
+            if not text and the_key not in bytes_keys:
+                the_value = the_value.decode('latin-1')
+            cyw_dict.add(the_key, the_value)
+            if value_end > last:
+                return cyw_dict
+            if value_end + 1 == last:
+                return   # the single tilde must be followed by a key
+            # the character after a single tilde is the first character of the next key
+            key_start = value_end + 1
+            check_from = value_end + 2
 
     def send_discovery(self, to_networks=None):
         send_data = CreateSendData()
@@ -1480,29 +2675,38 @@ class CywInterface:
             send_data.to_networks = to_networks
         send_data.data_type = 'Discovery'
         send_data.data = '?'
+        send_data.priority = True
         self.send_data(send_data)
 
     def get_buffered_amount(self):
-        return self.__locals.to_master_for_cloud_queue.get_size()
+        """Return the amount of data waiting in the send buffer to be uploaded
+        :return: Number of bytes
+        """
+        l = self.__locals
+        buffered = l.to_master_for_cloud_queue.get_bytes() + l.to_master_for_cloud_control_queue.get_bytes()
+        if l.spool is not None:
+            buffered += l.spool.get_bytes()
+        return buffered
 
-    def set_new_websocket_keep_alive_timeout(self, seconds_from_now):
-        self.tick_websocket_keep_alive = self.get_epoch_time() + seconds_from_now
+    def set_new_websocket_keep_alive_timeout(self, milliseconds_from_now):
+        self.__locals.master_vars.timers.start('keep_alive', milliseconds_from_now)
 
     def check_if_websocket_keep_alive_expired(self):
-        if self.tick_websocket_keep_alive < self.get_epoch_time():
-            return True  # expired
-        return False
+        return not self.__locals.master_vars.timers.is_running('keep_alive')
 
     def websocket_onopen(self, ws):
         l = self.__locals
         l.logger.debug('WebSocket onopen event')
         l.websocket_state = l.constants.ws_state_connected_not_auth
+        l.websocket_decoder.reset()
+        l.master_wakeup.set()
 
     def websocket_onclose(self, ws):
         l = self.__locals
         l.logger.debug('WebSocket onclose event')
         if l.websocket_state != l.constants.ws_state_waiting_for_connection:  # connection has already been restarted
             l.websocket_state = l.constants.ws_state_not_connected
+        l.master_wakeup.set()
 
     def websocket_onerror(self, ws, error):
         l = self.__locals
@@ -1511,22 +2715,24 @@ class CywInterface:
         l.websocket_state = l.constants.ws_state_not_connected
         l.websocket.close()
         l.cyw_state = l.constants.state_request_credentials
+        l.master_wakeup.set()
 
     def websocket_onmessage(self, ws, message):
         l = self.__locals
         l.logger.debug('WebSocket onmessage event')
-        # convert byte array to string
-        data = ''
-        for b in message:
-            data += chr(b)
+        # the data is kept as bytes, a text frame is converted back to the bytes that were sent
+        if isinstance(message, str):
+            message = message.encode('utf-8')
         if l.log_level == logging.DEBUG:
             # log detailed data about the data that was received
             log_str = "WebSocket onmessage event, data received: " \
-                      + CywInterface.bracket_encode(data)
+                      + CywInterface.bracket_encode(message)
             l.logger.debug(log_str)
-        l.websocket_rec_data_buf += data
-        while self.process_websocket_rec_data():
-            pass
+        overflows = l.websocket_decoder.overflows
+        for cyw_dict in l.websocket_decoder.feed(message):
+            l.websocket_receive_queue.put(cyw_dict)
+        if l.websocket_decoder.overflows != overflows:
+            l.logger.error('WebSocket message larger than the receive buffer, data discarded')
 
     def websocket_thread(self):
         """This function must never be called directly by user. Call Start() to start the service
@@ -1537,9 +2743,13 @@ class CywInterface:
         l.websocket_thread_terminated = False
         l.logger.info('WebSocket thread started')
         while l.websocket_thread_running:
-            if not l.use_websocket:
-                time.sleep(0.2)  # this thread must not do anything when long polling is used
-            else:
+            with l.thread_condition:
+                # this thread must not do anything when long polling is used, there is no session or the connection
+                # does not have to be created
+                l.thread_condition.wait_for(lambda: (l.use_websocket and l.cyw_state == l.constants.state_running
+                                                     and l.websocket_state == l.constants.ws_state_not_connected)
+                                            or not l.websocket_thread_running)
+            if l.websocket_thread_running:
                 if l.cyw_state == l.constants.state_running:
                     if l.websocket_state == l.constants.ws_state_not_connected:
                         try:
@@ -1557,23 +2767,10 @@ class CywInterface:
                             l.websocket.run_forever()
                             l.logger.debug('WebSocket connection returned')
                             l.websocket_state = l.constants.ws_state_waiting_for_connection
+                            l.master_wakeup.set()
                         except:
                             l.logger.debug('Error opening WebSocket connection')
-                            time.sleep(1)
-            time.sleep(0.1)
+                            with l.thread_condition:
+                                l.thread_condition.wait_for(lambda: not l.websocket_thread_running, 1)
         l.websocket_thread_terminated = True
         l.logger.debug('WebSocket thread terminated')
-
-    def process_websocket_rec_data(self):
-        l = self.__locals
-        try:
-            terminating_tag_index = l.websocket_rec_data_buf.index(l.constants.terminating_string)
-            # at least one complete message was received
-            terminating_tag_index += 4  # add size of terminating tag
-            new_message = l.websocket_rec_data_buf[:terminating_tag_index]
-            l.websocket_rec_data_buf = l.websocket_rec_data_buf[terminating_tag_index:] # remove received part
-            dict = CywInterface.decode_cyw_protocol(new_message)
-            l.websocket_receive_queue.put(dict)
-        except:
-            return False
-        return True
\ No newline at end of file
@@ -0,0 +1,591 @@
+#!/usr/bin/python
+
+"""
+Local stand-in for the Control Your Way server, used for testing and benchmarking without network access.
+
+It implements the part of the protocol used by ControlYourWay_p3.CywInterface: /GetCredentials, /Upload,
+the /Download long polling page, /CancelDownload and the /api/WebSocket endpoint where every message ends
+with ~t=1. Any number of devices can connect and data is routed between them by network name or session ID.
+Latency and message loss can be injected, and with echo enabled every data message is sent back to the
+device that sent it.
+
+Only the Python standard library is used. To connect the library to it:
+    cyw = ControlYourWay_p3.CywInterface()
+    cyw.set_use_test_server(True, 'localhost:60061')
+    cyw.set_use_encryption(False)
+
+Run python3 CywTestServer_p3.py --help for the available options.
+"""
+
+import argparse
+import base64
+import hashlib
+import heapq
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+TERMINATING_STRING = '~t=1'
+
+ERROR_CODES = [
+    ('0', 'Success'),
+    ('1', 'Unknown error'),
+    ('2', 'Data could not be sent to one or more recipients'),
+    ('4', 'New set of networks to which device is listening was set'),
+    ('7', 'Protocol error'),
+    ('8', 'Invalid user name or network password'),
+    ('12', 'Invalid or expired session ID'),
+    ('15', 'Download request cancelled by user'),
+    ('16', 'No data available'),
+]
+
+
+def tilde_encode(value):
+    """Escape the tilde and ASCII 0 characters
+    :param value: The string that must be encoded
+    :return: The encoded string
+    """
+    return value.replace('~', '~~').replace('\x00', '~-')
+
+
+def encode_fields(fields):
+    """Build a protocol message from a list of (key, value) pairs
+    :param fields: List of (key, value) pairs
+    :return: The encoded message
+    """
+    return ''.join(['~' + key + '=' + tilde_encode(value) for key, value in fields])
+
+
+def decode_fields(text):
+    """Split a protocol message into a list of (key, value) pairs. Decoding stops at the first malformed field
+    :param text: The received message
+    :return: List of (key, value) pairs in the order they were received
+    """
+    fields = []
+    pos = 0
+    size = len(text)
+    while pos < size and text[pos] == '~':
+        equals = text.find('=', pos + 1)
+        if equals < 0:
+            break
+        key = text[pos + 1:equals]
+        parts = []
+        start = equals + 1
+        while True:
+            tilde = text.find('~', start)
+            if tilde < 0 or tilde == size - 1:
+                parts.append(text[start:tilde] if tilde >= 0 else text[start:])
+                pos = size
+                break
+            parts.append(text[start:tilde])
+            next_char = text[tilde + 1]
+            if next_char == '~':
+                parts.append('~')
+                start = tilde + 2
+            elif next_char == '-':
+                parts.append('\x00')
+                start = tilde + 2
+            else:
+                pos = tilde
+                break
+        fields.append((key, ''.join(parts)))
+    return fields
+
+
+def to_wire(text):
+    """Convert a message to bytes. Every character below 256 becomes one byte, which is how the library
+    converts received bytes back to characters. Messages with other characters are sent as UTF-8
+    """
+    try:
+        return text.encode('latin-1')
+    except UnicodeEncodeError:
+        return text.encode('utf-8')
+
+
+class DataMessage:
+    def __init__(self):
+        self.from_session_id = 0
+        self.data_type = ''
+        self.data = ''
+        self.to_networks = []
+        self.to_session_ids = []
+
+
+class Session:
+    def __init__(self, session_id, user_name):
+        self.session_id = session_id
+        self.device_id = str(session_id) + 's' + '%08x' % random.getrandbits(32)
+        self.user_name = user_name
+        self.networks = []
+        self.websocket = None
+        self.inbox = []
+        self.condition = threading.Condition()
+        self.download_cancelled = False
+
+
+class Scheduler:
+    """Runs callables after a delay on one background thread, used to inject latency"""
+    def __init__(self):
+        self._heap = []
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def schedule(self, delay, fn):
+        with self._condition:
+            self._counter += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._counter, fn))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] - time.monotonic()
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+                _, _, fn = heapq.heappop(self._heap)
+            fn()
+
+
+def unmask(payload, mask):
+    """Remove the mask the client applied to a WebSocket frame, all bytes are processed in one operation"""
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+
+class WebSocketConnection:
+    """Minimal RFC 6455 server side connection. Frames sent by the client are masked, frames sent by the server
+    are binary frames without a mask"""
+    def __init__(self, sock, rfile):
+        self._sock = sock
+        self._file = rfile
+        self._send_lock = threading.Lock()
+        self.closed = False
+
+    def _read_exact(self, size):
+        data = self._file.read(size)
+        if data is None or len(data) < size:
+            raise ConnectionError('WebSocket connection closed')
+        return data
+
+    def receive(self):
+        """Return the opcode and payload of the next data message, or None when the connection was closed"""
+        message = b''
+        message_opcode = None
+        while True:
+            header = self._read_exact(2)
+            opcode = header[0] & 0x0f
+            final = header[0] & 0x80
+            length = header[1] & 0x7f
+            if length == 126:
+                length = struct.unpack('>H', self._read_exact(2))[0]
+            elif length == 127:
+                length = struct.unpack('>Q', self._read_exact(8))[0]
+            mask = self._read_exact(4) if header[1] & 0x80 else None
+            payload = self._read_exact(length)
+            if mask is not None:
+                payload = unmask(payload, mask)
+            if opcode == 0x8:  # close
+                self.close()
+                return None
+            if opcode == 0x9:  # ping
+                self._send_frame(0xa, payload)
+                continue
+            if opcode == 0xa:  # pong
+                continue
+            if message_opcode is None:
+                message_opcode = opcode  # continuation frames have opcode 0
+            message += payload
+            if final:
+                return message_opcode, message
+
+    def _send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        with self._send_lock:
+            if not self.closed:
+                self._sock.sendall(header + payload)
+
+    def send(self, text):
+        try:
+            self._send_frame(0x2, to_wire(text))
+        except OSError:
+            self.closed = True
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._send_frame(0x8, b'')
+            except OSError:
+                pass
+            self.closed = True
+
+
+class CywTestServer:
+    def __init__(self, host='localhost', port=60061, users=None, latency=0.0, loss=0.0, echo=False,
+                 download_timeout=None):
+        """
+        :param host: Host name the server listens on and advertises to the devices
+        :param port: TCP port, 0 picks a free port
+        :param users: Dictionary of user name to password. If None any user name and password is accepted
+        :param latency: Seconds added before every response and every delivered message
+        :param loss: Fraction of data messages that are silently dropped instead of delivered (0 to 1)
+        :param echo: If True every data message is also sent back to the device that sent it
+        :param download_timeout: Maximum seconds a long polling download request waits, None uses the timeout
+        requested by the device
+        """
+        self.users = users
+        self.latency = latency
+        self.loss = loss
+        self.echo = echo
+        self.download_timeout = download_timeout
+        self.on_data_message = None  # called with every DataMessage received from a device
+        self.messages_received = 0
+        self.messages_delivered = 0
+        self.messages_dropped = 0
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._next_session_id = 1
+        self._scheduler = Scheduler()
+        self._httpd = ThreadingHTTPServer((host, port), CywRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.cyw_server = self
+        self.host = host
+        self.port = self._httpd.server_address[1]
+        self._thread = None
+
+    def get_server_name(self):
+        return self.host + ':' + str(self.port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._scheduler.stop()
+        with self._sessions_lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            if session.websocket is not None:
+                session.websocket.close()
+            with session.condition:
+                session.download_cancelled = True
+                session.condition.notify_all()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def delay(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def get_session(self, device_id):
+        with self._sessions_lock:
+            return self._sessions.get(device_id)
+
+    def get_sessions(self):
+        with self._sessions_lock:
+            return list(self._sessions.values())
+
+    def get_credentials(self, fields):
+        values = dict(fields)
+        user_name = values.get('u', '')
+        password = values.get('ps', '')
+        if user_name == '' or (self.users is not None and self.users.get(user_name) != password):
+            return encode_fields([('e', '8')])
+        with self._sessions_lock:
+            session = Session(self._next_session_id, user_name)
+            self._next_session_id += 1
+            self._sessions[session.device_id] = session
+        server_name = self.get_server_name()
+        response = [('e', '0'), ('id', session.device_id), ('ip', server_name), ('ip', server_name),
+                    ('dn', server_name), ('dn', server_name)]
+        if values.get('ec') == '1':
+            response += ERROR_CODES
+        return encode_fields(response)
+
+    def terminate_session(self, session):
+        with self._sessions_lock:
+            self._sessions.pop(session.device_id, None)
+
+    def set_networks(self, session, networks):
+        session.networks = [n for n in networks if n != '']
+
+    @staticmethod
+    def parse_data_messages(fields, from_session_id):
+        """Group upload fields into messages, every ~d= field ends a message"""
+        messages = []
+        message = DataMessage()
+        message.from_session_id = from_session_id
+        for key, value in fields:
+            if key == 'n':
+                message.to_networks.append(value)
+            elif key == 's':
+                message.to_session_ids.append(value)
+            elif key == 'dt':
+                message.data_type = value
+            elif key == 'd':
+                message.data = value
+                messages.append(message)
+                message = DataMessage()
+                message.from_session_id = from_session_id
+        return messages
+
+    def route(self, sender, messages):
+        """Deliver data messages received from a device. Return the error code for the sender"""
+        error_code = '0'
+        sessions = self.get_sessions()
+        for message in messages:
+            self.messages_received += 1
+            if self.on_data_message is not None:
+                self.on_data_message(message)
+            if message.to_session_ids:
+                recipients = [s for s in sessions if str(s.session_id) in message.to_session_ids]
+                if len(recipients) < len(message.to_session_ids):
+                    error_code = '2'
+            else:
+                networks = message.to_networks or sender.networks
+                recipients = [s for s in sessions if s is not sender and s.user_name == sender.user_name and
+                              any(n in s.networks for n in networks)]
+            if self.echo and sender not in recipients:
+                recipients.append(sender)
+            for recipient in recipients:
+                if self.loss > 0 and random.random() < self.loss:
+                    self.messages_dropped += 1
+                    continue
+                if self.latency > 0:
+                    self._scheduler.schedule(self.latency, lambda r=recipient, m=message: self.deliver(r, m))
+                else:
+                    self.deliver(recipient, message)
+        return error_code
+
+    def deliver(self, session, message):
+        self.messages_delivered += 1
+        fields = [('f', str(message.from_session_id)), ('dt', message.data_type), ('d', message.data)]
+        if session.websocket is not None:
+            session.websocket.send(encode_fields([('rt', 'r')] + fields) + TERMINATING_STRING)
+        else:
+            with session.condition:
+                session.inbox.extend(fields)
+                session.condition.notify_all()
+
+    def inject(self, data, data_type='', networks=None, user_name=None):
+        """Send data to devices as if it came from a device with session ID 0
+        :param data: The data to send
+        :param data_type: The data type
+        :param networks: Network names, if None the data is sent to every device
+        :param user_name: Only send to devices of this user, if None send to the devices of all users
+        """
+        message = DataMessage()
+        message.data = data
+        message.data_type = data_type
+        for session in self.get_sessions():
+            if user_name is not None and session.user_name != user_name:
+                continue
+            if networks is not None and not any(n in session.networks for n in networks):
+                continue
+            self.deliver(session, message)
+
+    def wait_for_download(self, session, timeout):
+        """Block a long polling download request until data is available, it is cancelled or it times out"""
+        deadline = time.monotonic() + timeout
+        with session.condition:
+            while not session.inbox and not session.download_cancelled:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                session.condition.wait(remaining)
+            if session.download_cancelled:
+                session.download_cancelled = False
+                return [('e', '15')]
+            if not session.inbox:
+                return [('e', '16')]
+            fields = [('e', '0')] + session.inbox
+            session.inbox = []
+            return fields
+
+    def cancel_download(self, session):
+        with session.condition:
+            session.download_cancelled = True
+            session.condition.notify_all()
+
+    def handle_websocket_message(self, session, ws, fields):
+        """Handle one message received over a WebSocket connection. Return the session, which is only known
+        after the device has authenticated"""
+        if not fields:
+            # keep alive
+            ws.send('~rt=k' + TERMINATING_STRING)
+            return session
+        key = fields[0][0]
+        if key == 'id':
+            session = self.get_session(fields[0][1])
+            if session is None:
+                ws.send(encode_fields([('rt', 'a'), ('e', '12')]) + TERMINATING_STRING)
+            else:
+                session.websocket = ws
+                ws.send(encode_fields([('rt', 'a'), ('e', '0')]) + TERMINATING_STRING)
+        elif session is None:
+            ws.send(encode_fields([('rt', 's'), ('e', '12')]) + TERMINATING_STRING)
+        elif key == 'nc':
+            self.set_networks(session, [v for k, v in fields if k == 'ns'])
+            ws.send(encode_fields([('rt', 'n'), ('e', '4')]) + TERMINATING_STRING)
+        elif key == 'c':
+            ws.send(encode_fields([('rt', 'c'), ('e', '0')]) + TERMINATING_STRING)
+            if fields[0][1] == 't':
+                self.terminate_session(session)
+        else:
+            error_code = self.route(session, self.parse_data_messages(fields, session.session_id))
+            response = [('rt', 's'), ('e', error_code)]
+            # the upload counter is sent back so that the device knows which upload the response is for
+            response += [(k, v) for k, v in fields if k == 'z']
+            ws.send(encode_fields(response) + TERMINATING_STRING)
+        return session
+
+
+class CywRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections alive between requests
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_response(self, text):
+        body = to_wire(text)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server.cyw_server
+        length = int(self.headers.get('Content-Length', 0))
+        fields = decode_fields(self.rfile.read(length).decode('latin-1'))
+        server.delay()
+        if self.path == '/GetCredentials':
+            self._send_response(server.get_credentials(fields))
+            return
+        if self.path not in ('/Upload', '/Download', '/CancelDownload'):
+            self.send_error(404)
+            return
+        session = None
+        if fields and fields[0][0] == 'id':
+            session = server.get_session(fields[0][1])
+        if session is None:
+            self._send_response(encode_fields([('e', '12')]))
+            return
+        fields = [field for field in fields if field[0] not in ('id', 'z')]
+        if self.path == '/Upload':
+            error_code = server.route(session, server.parse_data_messages(fields, session.session_id))
+            self._send_response(encode_fields([('e', error_code)]))
+        elif self.path == '/CancelDownload':
+            server.cancel_download(session)
+            if ('ts', '1') in fields:
+                server.terminate_session(session)
+            self._send_response(encode_fields([('e', '15')]))
+        else:
+            networks = [value for key, value in fields if key == 'n']
+            if networks:
+                server.set_networks(session, networks)
+                self._send_response(encode_fields([('e', '4')]))
+                return
+            timeout = 120
+            for key, value in fields:
+                if key == 't':
+                    timeout = int(value)
+            if server.download_timeout is not None:
+                timeout = min(timeout, server.download_timeout)
+            self._send_response(encode_fields(server.wait_for_download(session, timeout)))
+
+    def do_GET(self):
+        if self.path != '/api/WebSocket' or self.headers.get('Upgrade', '').lower() != 'websocket':
+            self.send_error(404)
+            return
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server = self.server.cyw_server
+        ws = WebSocketConnection(self.connection, self.rfile)
+        session = None
+        try:
+            while not ws.closed:
+                message = ws.receive()
+                if message is None:
+                    break
+                opcode, payload = message
+                if opcode == 0x2:  # binary, the same conversion as the long polling requests
+                    text = payload.decode('latin-1')
+                else:
+                    text = payload.decode('utf-8', errors='replace')
+                if not text.endswith(TERMINATING_STRING):
+                    continue  # every message sent by the library ends with the terminating string
+                server.delay()
+                fields = decode_fields(text[:-len(TERMINATING_STRING)])
+                session = server.handle_websocket_message(session, ws, fields)
+        except (ConnectionError, OSError):
+            pass
+        if session is not None and session.websocket is ws:
+            session.websocket = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Control Your Way server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=60061)
+    parser.add_argument('--user', action='append', default=[],
+                        help='user:password that is allowed to connect, can be used more than once. '
+                             'If not used any user name and password is accepted')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every hop')
+    parser.add_argument('--loss', type=float, default=0, help='fraction of data messages to drop, 0 to 1')
+    parser.add_argument('--echo', action='store_true', help='send every data message back to its sender')
+    parser.add_argument('--download-timeout', type=int, default=None,
+                        help='maximum seconds a long polling download request waits')
+    args = parser.parse_args()
+    users = None
+    if args.user:
+        users = dict(u.split(':', 1) for u in args.user)
+    server = CywTestServer(args.host, args.port, users, args.latency / 1000.0, args.loss, args.echo,
+                           args.download_timeout)
+    print('Control Your Way test server listening on ' + server.get_server_name())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
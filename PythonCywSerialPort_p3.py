@@ -1,5 +1,5 @@
-import serial, time, sys, signal, configparser
-from threading import Thread
+import serial, time, sys, signal, configparser, select, queue
+from threading import Thread, Event
 import ControlYourWay_p3
 import logging
 import os
@@ -18,6 +18,28 @@ class SerialPort:
         self._serial = None
         self._running = False
         self._thread = None
+        self._read_mode = 'bulk'
+        self._max_chunk_size = 4096
+        self._read_timeout = 0.25
+        # flow control used to stop the device from sending when the cloud connection cannot keep up, see
+        # set_flow_control. The port is only read while _rx_enabled is set
+        self._flow_control = 'none'
+        self._flow_control_high_watermark = 65536
+        self._flow_control_low_watermark = 16384
+        self._rx_enabled = Event()
+        self._rx_enabled.set()
+        self._rx_paused = False
+        self.rx_pauses = 0
+        # downlink data is written by a dedicated thread so that a slow port never blocks the caller
+        self._write_queue = queue.Queue(256)
+        self._write_queue_timeout = 10.0
+        self._write_drop_callback = None
+        self._write_thread = None
+        self._max_write_size = 65536
+        self.write_queue_high_water = 0
+        self.write_queue_dropped = 0
+        self.bytes_written = 0
+        self.writes = 0
 
     def set_parity(self, new_parity):
         if new_parity == 'E' or new_parity == 'e':
@@ -39,45 +61,518 @@ class SerialPort:
     def set_rx_callback(self, rx_callback):
         self._rx_callback = rx_callback
 
+    def set_read_mode(self, new_read_mode):
+        # 'bulk' waits for the port to become readable and drains everything available in one read,
+        # 'byte' reads one byte at a time like older versions of this script
+        if new_read_mode == 'byte' or new_read_mode == 'bulk':
+            self._read_mode = new_read_mode
+
+    def set_max_chunk_size(self, new_max_chunk_size):
+        # maximum number of bytes handed to the rx callback in one call when the bulk read mode is used
+        if int(new_max_chunk_size) > 0:
+            self._max_chunk_size = int(new_max_chunk_size)
+
+    def set_write_queue_size(self, new_write_queue_size):
+        # maximum number of downlink messages waiting to be written to the port. Must be set before the port is opened
+        if int(new_write_queue_size) > 0:
+            self._write_queue = queue.Queue(int(new_write_queue_size))
+
+    def get_write_queue_depth(self):
+        return self._write_queue.qsize()
+
+    def set_write_queue_timeout(self, new_write_queue_timeout):
+        # seconds send_data waits for space in a full write queue, this slows down the data from the cloud to the
+        # speed of the port. Data that does not fit in time is dropped, 0 drops it without waiting
+        if float(new_write_queue_timeout) >= 0:
+            self._write_queue_timeout = float(new_write_queue_timeout)
+
+    def set_write_drop_callback(self, write_drop_callback):
+        # called with the number of bytes when downlink data is dropped because the write queue stayed full
+        self._write_drop_callback = write_drop_callback
+
+    def set_flow_control(self, new_flow_control, high_watermark=65536, low_watermark=16384):
+        # the port is paused when the data waiting to be sent to the cloud reaches high_watermark bytes and resumed
+        # when it drops to low_watermark bytes. Must be set before the port is opened. Options are:
+        # 'none' - the port is always read, data that does not fit in the rx buffer is dropped
+        # 'stopreading' - the port is not read while paused, the driver and device buffers fill up
+        # 'rtscts' - hardware flow control, the port is not read while paused and the driver drops RTS when its
+        # buffer is full
+        # 'xonxoff' - software flow control, XOFF is sent when paused and XON when resumed
+        if new_flow_control in ('none', 'stopreading', 'rtscts', 'xonxoff'):
+            self._flow_control = new_flow_control
+        if int(high_watermark) > 0:
+            self._flow_control_high_watermark = int(high_watermark)
+        self._flow_control_low_watermark = max(0, int(low_watermark))
+
+    def get_flow_control(self):
+        return self._flow_control, self._flow_control_high_watermark, self._flow_control_low_watermark
+
+    def pause_rx(self):
+        # ask the device to stop sending
+        if self._flow_control == 'none' or self._rx_paused:
+            return
+        self._rx_paused = True
+        self.rx_pauses += 1
+        if self._flow_control == 'xonxoff':
+            self._write_flow_control_character(serial.XOFF)
+        else:
+            self._rx_enabled.clear()
+
+    def resume_rx(self):
+        if not self._rx_paused:
+            return
+        self._rx_paused = False
+        if self._flow_control == 'xonxoff':
+            self._write_flow_control_character(serial.XON)
+        else:
+            self._rx_enabled.set()
+
+    def _write_flow_control_character(self, character):
+        # XON and XOFF are written directly, queued downlink data could delay them
+        try:
+            self._serial.write(character)
+        except (OSError, ValueError, serial.SerialException):
+            pass
+
     def open_serial_port(self):
         self._serial = serial.Serial(port=self._port, baudrate=self._baudrate, parity=self._parity,
-                                     stopbits=self._stop_bits, bytesize=self._number_of_bits, timeout=0.25)
+                                     stopbits=self._stop_bits, bytesize=self._number_of_bits,
+                                     timeout=self._read_timeout, xonxoff=self._flow_control == 'xonxoff',
+                                     rtscts=self._flow_control == 'rtscts')
         # Create thread
         self._running = True
-        self._thread = Thread(target=self._update)
+        if self._read_mode == 'bulk':
+            self._thread = Thread(target=self._update_bulk)
+        else:
+            self._thread = Thread(target=self._update)
         self._thread.start()
+        self._write_thread = Thread(target=self._write_data)
+        self._write_thread.start()
 
     def close_serial_port(self):
         self._running = False
+        self._rx_enabled.set()  # wake up the reader thread
+        try:
+            self._write_queue.put_nowait(None)  # wake up the writer thread
+        except queue.Full:
+            pass
+        # the threads stop within one read timeout, the port is closed after they stopped using it
+        self._thread.join()
+        self._write_thread.join()
         self._serial.close()
 
     def _update(self):
         while self._running:
+            if not self._rx_enabled.is_set():
+                self._rx_enabled.wait(self._read_timeout)
+                continue
             c = self._serial.read(1)
             if c:
                 if self._rx_callback:
                     self._rx_callback(c)
         return False
 
+    def _wait_for_data(self):
+        # block on the port file descriptor until data is available. Ports without a file descriptor
+        # (for example on Windows) block in a one byte read instead
+        try:
+            fd = self._serial.fileno()
+        except Exception:
+            fd = None
+        if fd is not None:
+            readable, _, _ = select.select([fd], [], [], self._read_timeout)
+            if not readable or not self._running:
+                return b''
+            return self._serial.read(min(max(self._serial.in_waiting, 1), self._max_chunk_size))
+        return self._serial.read(1)
+
+    def _update_bulk(self):
+        while self._running:
+            if not self._rx_enabled.is_set():
+                self._rx_enabled.wait(self._read_timeout)
+                continue
+            try:
+                chunk = self._wait_for_data()
+                # drain whatever else arrived in the same burst without waiting again
+                if chunk and len(chunk) < self._max_chunk_size:
+                    waiting = self._serial.in_waiting
+                    if waiting:
+                        chunk += self._serial.read(min(waiting, self._max_chunk_size - len(chunk)))
+            except (OSError, ValueError, TypeError, serial.SerialException):
+                # port was closed while waiting
+                break
+            if chunk:
+                if self._rx_callback:
+                    self._rx_callback(chunk)
+        return False
+
+    def _write_data(self):
+        while self._running:
+            data = self._write_queue.get()
+            if data is None:
+                continue
+            # coalesce everything that is already queued into one write
+            chunks = [data]
+            size = len(data)
+            while size < self._max_write_size:
+                try:
+                    data = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if data is None:
+                    break
+                chunks.append(data)
+                size += len(data)
+            try:
+                if len(chunks) == 1:
+                    self._serial.write(chunks[0])
+                else:
+                    self._serial.write(b''.join(chunks))
+            except (OSError, ValueError, serial.SerialException):
+                # port was closed while writing
+                break
+            self.bytes_written += size
+            self.writes += 1
+        return False
+
     def send_data(self, data):
+        if type(data) is list:
+            data = bytes(data)
+        elif type(data) is str:
+            # every character is one byte on the wire, encode the whole string in one step
+            data = data.encode('latin-1')
+        self.send_bytes(data)
+
+    def send_bytes(self, data):
+        # binary send path: bytes, bytearray or memoryview are queued for the writer thread as they are, without
+        # conversion or copying. The caller must not modify a bytearray after passing it in
         if self._running:
-            if type(data) is list:
-                data = bytearray(data)
-            data_bytes = bytearray()
-            data_bytes.extend(map(ord,data))
-            self._serial.write(data_bytes)
+            try:
+                self._write_queue.put(data, timeout=self._write_queue_timeout)
+            except queue.Full:
+                self.write_queue_dropped += 1
+                if self._write_drop_callback is not None:
+                    self._write_drop_callback(len(data))
+                return
+            depth = self._write_queue.qsize()
+            if depth > self.write_queue_high_water:
+                self.write_queue_high_water = depth
+
+
+class ByteRingBuffer:
+    # Preallocated byte ring buffer shared between exactly one producer thread (serial rx) and one consumer
+    # thread (cloud collector). The producer only moves _write_pos and the consumer only moves _read_pos, so no
+    # lock is needed. Both positions count up forever and are wrapped with the capacity when indexing
+    def __init__(self, capacity=65536):
+        self._capacity = int(capacity)
+        self._buffer = bytearray(self._capacity)
+        self._view = memoryview(self._buffer)
+        self._write_pos = 0
+        self._read_pos = 0
+        self.overruns = 0
+        self.overrun_bytes = 0
+
+    def get_capacity(self):
+        return self._capacity
+
+    def get_write_position(self):
+        return self._write_pos
+
+    def get_read_position(self):
+        return self._read_pos
+
+    def __len__(self):
+        return self._write_pos - self._read_pos
+
+    def write(self, data):
+        # called by the producer. Bytes that do not fit are dropped and counted as an overrun
+        size = len(data)
+        free = self._capacity - (self._write_pos - self._read_pos)
+        if size > free:
+            self.overruns += 1
+            self.overrun_bytes += size - free
+            size = free
+            if size == 0:
+                return 0
+        start = self._write_pos % self._capacity
+        first = min(size, self._capacity - start)
+        self._view[start:start + first] = data[:first]
+        if first < size:
+            self._view[:size - first] = data[first:size]
+        self._write_pos += size
+        return size
+
+    def peek(self, max_bytes=None):
+        # called by the consumer. Return the buffered data as one or two memoryviews into the buffer without
+        # copying it. The data stays in the buffer until consume() is called
+        size = self._write_pos - self._read_pos
+        if max_bytes is not None and size > max_bytes:
+            size = max_bytes
+        start = self._read_pos % self._capacity
+        first = min(size, self._capacity - start)
+        views = [self._view[start:start + first]]
+        if first < size:
+            views.append(self._view[:size - first])
+        return views
+
+    def consume(self, size):
+        # called by the consumer once the data returned by peek() has been used
+        self._read_pos += min(size, self._write_pos - self._read_pos)
+
+
+class FlushPolicy:
+    # Decides when buffered serial data is sent to the cloud. Data is flushed as soon as flush_bytes are buffered,
+    # when no new data arrived for idle_gap_us microseconds or when the oldest buffered byte is max_latency_us
+    # microseconds old, whichever comes first
+    def __init__(self, flush_bytes=1024, idle_gap_us=1000, max_latency_us=10000):
+        self.flush_bytes = int(flush_bytes)
+        self.idle_gap_us = int(idle_gap_us)
+        self.max_latency_us = int(max_latency_us)
+
+
+class DelimiterFramer:
+    # Frames end with a delimiter, for example a newline. Every received chunk is scanned once, the last
+    # len(delimiter) - 1 bytes are kept so that a delimiter split across two chunks is still found
+    idle_gap = None
+
+    def __init__(self, delimiter=b'\n'):
+        self._delimiter = bytes(delimiter)
+        self._tail = b''
+
+    def feed(self, data, idle_time):
+        # return the offset in data just after the last complete frame, -1 if no frame was completed
+        if len(self._delimiter) == 1:
+            index = data.rfind(self._delimiter)
+            if index < 0:
+                return -1
+            return index + 1
+        search = self._tail + bytes(data)
+        index = search.rfind(self._delimiter)
+        self._tail = search[-(len(self._delimiter) - 1):]
+        if index < 0:
+            return -1
+        return index + len(self._delimiter) - (len(search) - len(data))
+
+
+class SlipFramer(DelimiterFramer):
+    # SLIP (RFC 1055) frames end with the END byte 0xC0
+    def __init__(self):
+        DelimiterFramer.__init__(self, b'\xc0')
+
+
+class CobsFramer(DelimiterFramer):
+    # COBS encoded frames never contain a zero byte, a zero byte marks the end of every frame
+    def __init__(self):
+        DelimiterFramer.__init__(self, b'\x00')
+
+
+class LengthPrefixFramer:
+    # Every frame starts with a fixed size length field which holds the number of bytes following it. The parser
+    # jumps from one length field to the next so the frame contents are never scanned
+    idle_gap = None
+
+    def __init__(self, prefix_size=2, byte_order='big'):
+        self._prefix_size = int(prefix_size)
+        self._byte_order = byte_order
+        self._header = bytearray()
+        self._remaining = 0
+
+    def feed(self, data, idle_time):
+        last_end = -1
+        pos = 0
+        size = len(data)
+        while pos < size:
+            if self._remaining > 0:
+                take = min(self._remaining, size - pos)
+                pos += take
+                self._remaining -= take
+                if self._remaining == 0:
+                    last_end = pos
+            else:
+                take = min(self._prefix_size - len(self._header), size - pos)
+                self._header += data[pos:pos + take]
+                pos += take
+                if len(self._header) == self._prefix_size:
+                    self._remaining = int.from_bytes(self._header, self._byte_order)
+                    self._header = bytearray()
+                    if self._remaining == 0:
+                        last_end = pos
+        return last_end
+
+
+class IdleGapFramer:
+    # Modbus RTU frames are separated by at least 3.5 character times of silence on the line. All the buffered
+    # data is complete once the line has been idle for idle_gap seconds
+    def __init__(self, baudrate, bits_per_character=11):
+        baudrate = int(baudrate)
+        if baudrate > 19200:
+            self.idle_gap = 0.00175  # fixed value recommended by the Modbus specification
+        else:
+            self.idle_gap = 3.5 * bits_per_character / baudrate
+
+    def feed(self, data, idle_time):
+        if idle_time >= self.idle_gap:
+            return 0  # everything received before this chunk was a complete frame
+        return -1
+
+
+class SerialPortBridge:
+    # Connects one serial port to the cloud. Every port has its own datatype, rx buffer, flush policy and payload
+    # mode. Data from the cloud is routed to the port with the matching datatype
+    def __init__(self, serial_port, datatype, rx_buffer_size=65536, flush_policy=None, payload_mode='text',
+                 framer=None):
+        self._serial_port = serial_port
+        self._datatype = datatype
+        # text: serial data is UTF-8 text, a character is never split across two uploads. binary: the serial bytes
+        # are sent as they are. In both modes the bytes are passed to the cloud without conversion
+        self._payload_mode = payload_mode
+        self._text_partial = b''  # start of a UTF-8 character that was not completely received at the last flush
+        self._rx_buffer = ByteRingBuffer(rx_buffer_size)
+        self._rx_event = None
+        self._first_rx_time = None
+        self._last_rx_time = 0.0
+        if flush_policy is None:
+            flush_policy = FlushPolicy()
+        self._flush_policy = flush_policy
+        # when a framer is used only complete frames are sent, _frame_end_pos is the rx buffer write position just
+        # after the last complete frame
+        self._framer = framer
+        self._frame_end_pos = 0
+        self._serial_port.set_rx_callback(self.data_received)
+
+    def get_datatype(self):
+        return self._datatype
+
+    def get_rx_buffer(self):
+        return self._rx_buffer
+
+    def set_rx_event(self, rx_event):
+        # event that is set every time data is received, used to wake up the collector thread
+        self._rx_event = rx_event
+
+    def _get_complete_size(self, now):
+        # number of buffered bytes that can be sent
+        size = len(self._rx_buffer)
+        if self._framer is None or size >= self._rx_buffer.get_capacity():
+            return size  # a full buffer is sent as it is, otherwise the port would stall
+        if self._framer.idle_gap is not None and now - self._last_rx_time >= self._framer.idle_gap:
+            return size
+        complete = self._frame_end_pos - self._rx_buffer.get_read_position()
+        return max(0, min(complete, size))
+
+    def get_flush_deadline(self, now):
+        # return the time at which the buffered data must be sent, or None if there is nothing to send
+        size = self._get_complete_size(now)
+        if size == 0:
+            if len(self._rx_buffer) > 0 and self._framer is not None and self._framer.idle_gap is not None:
+                return self._last_rx_time + self._framer.idle_gap
+            return None
+        policy = self._flush_policy
+        if size >= policy.flush_bytes:
+            return now
+        first_rx_time = self._first_rx_time
+        if first_rx_time is None:
+            first_rx_time = self._last_rx_time
+        idle_deadline = self._last_rx_time + policy.idle_gap_us / 1000000.0
+        latency_deadline = first_rx_time + policy.max_latency_us / 1000000.0
+        return min(idle_deadline, latency_deadline)
+
+    @staticmethod
+    def _get_utf8_complete_length(data):
+        # return the length of data without a UTF-8 character at the end that is not complete. Invalid sequences
+        # are not checked, they are passed on as they are
+        for i in range(len(data) - 1, max(len(data) - 4, -1), -1):
+            lead = data[i]
+            if lead & 0xc0 == 0x80:
+                continue  # continuation byte
+            if lead >= 0xf0:
+                length = 4
+            elif lead >= 0xe0:
+                length = 3
+            elif lead >= 0xc0:
+                length = 2
+            else:
+                length = 1
+            return i if len(data) - i < length else len(data)
+        return len(data)
+
+    def flush(self, cyw):
+        views = self._rx_buffer.peek(self._get_complete_size(time.monotonic()))
+        size = sum(len(v) for v in views)
+        send_data = ControlYourWay_p3.CreateSendData()
+        if self._payload_mode == 'binary':
+            send_data.data = b''.join(views)
+        else:
+            # a UTF-8 character split across two flushes is held back until it is complete
+            data = self._text_partial + b''.join(views)
+            complete_length = self._get_utf8_complete_length(data)
+            self._text_partial = data[complete_length:]
+            send_data.data = data[:complete_length]
+        send_data.data_type = self._datatype
+        self._rx_buffer.consume(size)
+        if len(self._rx_buffer) > 0:
+            self._first_rx_time = time.monotonic()
+        else:
+            self._first_rx_time = None
+        if len(send_data.data) > 0:
+            cyw.send_data(send_data)
+
+    def send_data(self, data):
+        self._serial_port.send_data(data)
+
+    def get_flow_control(self):
+        return self._serial_port.get_flow_control()
+
+    def pause_rx(self):
+        self._serial_port.pause_rx()
+
+    def resume_rx(self):
+        self._serial_port.resume_rx()
+
+    def close(self):
+        self._serial_port.close_serial_port()
+
+    def set_write_drop_callback(self, write_drop_callback):
+        self._serial_port.set_write_drop_callback(lambda size: write_drop_callback(self._datatype, size))
+
+    # callback which will be called by serial port when data is received
+    def data_received(self, c):
+        write_pos = self._rx_buffer.get_write_position()
+        written = self._rx_buffer.write(c)
+        now = time.monotonic()
+        if self._framer is not None and written > 0:
+            if written < len(c):
+                c = c[:written]
+            frame_end = self._framer.feed(c, now - self._last_rx_time)
+            if frame_end >= 0:
+                self._frame_end_pos = write_pos + frame_end
+        self._last_rx_time = now
+        if self._first_rx_time is None:
+            self._first_rx_time = self._last_rx_time
+        if self._rx_event is not None:
+            self._rx_event.set()
 
 
 class ControlYourWay:
-    def __init__(self, cyw_username, cyw_password, serial_port, encryption, use_websocket, \
-                 cyw_network_names, cyw_datatype, log_directory):
+    def __init__(self, cyw_username, cyw_password, bridges, encryption, use_websocket, \
+                 cyw_network_names, log_directory, cyw_interface=None, send_window=1, spool_directory='',
+                 spool_max_size=67108864):
         self._log_directory = log_directory
-        self._cyw = ControlYourWay_p3.CywInterface()
+        # a different interface with the same API can be passed in, for example by the benchmark
+        if cyw_interface is None:
+            cyw_interface = ControlYourWay_p3.CywInterface()
+        self._cyw = cyw_interface
         self._cyw.set_user_name(cyw_username)
         self._cyw.set_network_password(cyw_password)
         self._cyw.set_network_names(cyw_network_names)
         self._cyw.set_connection_status_callback(self.connection_status_callback)
         self._cyw.set_data_received_callback(self.data_received_callback)
+        # data from the cloud is written to the serial port as it is received, without converting it to a string
+        self._cyw.set_receive_bytes(True)
+        self._cyw.set_send_window(send_window)
+        if spool_directory != '':
+            # data waiting to be sent is kept on disk and sent after an outage or a restart
+            self._cyw.set_spool_directory(spool_directory, spool_max_size)
         if self._log_directory != '':
             self._cyw.enable_logging(self._log_directory, logging.DEBUG, True)
         self._cyw.name = 'Python Serial Port'
@@ -88,35 +583,86 @@ class ControlYourWay:
             print("Connection type: Long polling")
         else:
             print("Connection type: WebSocket")
-        self._send_data_collected = ""
+        # all serial ports share one connection, the datatype is used to route data from the cloud to a port
+        self._bridges = bridges
+        self._bridges_by_datatype = {}
+        self._rx_event = Event()
+        for bridge in self._bridges:
+            self._bridges_by_datatype[bridge.get_datatype()] = bridge
+            bridge.set_rx_event(self._rx_event)
+            bridge.set_write_drop_callback(self.write_drop_callback)
+        # ports with flow control are paused while too much data is waiting to be sent to the cloud. All ports share
+        # one connection, with more than one port the lowest watermarks are used
+        flow_controls = [bridge.get_flow_control() for bridge in self._bridges]
+        flow_controls = [f for f in flow_controls if f[0] != 'none']
+        self._low_watermark = 0
+        self._rx_paused = False
+        # while paused the send buffer is checked at this interval, so that a low watermark callback that was missed
+        # never leaves the ports paused
+        self._resume_check_interval = 1.0
+        if len(flow_controls) > 0:
+            self._low_watermark = min(f[2] for f in flow_controls)
+            self._cyw.set_send_buffer_watermarks(min(f[1] for f in flow_controls), self._low_watermark)
+            self._cyw.set_high_watermark_callback(self.high_watermark_callback)
+            self._cyw.set_low_watermark_callback(self.low_watermark_callback)
+        self._running = False
+        self._thread = None
+
+    def start(self):
         self._cyw.start()
         self._running = True
-        self._datatype = cyw_datatype
         self._thread = Thread(target=self._collect_data)
         self._thread.start()
-        self._serial_port = serial_port
-        self._serial_port.set_rx_callback(self.data_received)
+
+    def stop(self):
+        self._cyw.close_connection(True)
+        self._running = False
+        self._rx_event.set()
+        for bridge in self._bridges:
+            bridge.close()
+        self._thread.join()
+
+    def run(self):
+        # start the service and block until Ctrl+C is pressed
+        self.start()
         print("Press Ctrl+C to quit")
         signal.signal(signal.SIGINT, self.signal_handler)
         while self._running:
             time.sleep(0.1)
 
     def signal_handler(self, signal, frame):
-        self._cyw.close_connection(True)
-        self._running = False
-        self._serial_port.close_serial_port()
+        self.stop()
         print('Program stopped')
         sys.exit(0)
 
     def _collect_data(self):
         while self._running:
-            if len(self._send_data_collected) > 0:
-                send_data = ControlYourWay_p3.CreateSendData()
-                send_data.data = self._send_data_collected
-                send_data.data_type = self._datatype
-                self._cyw.send_data(send_data)
-                self._send_data_collected = ""
-            time.sleep(0.01)
+            now = time.monotonic()
+            next_deadline = None
+            flushed = False
+            for bridge in self._bridges:
+                deadline = bridge.get_flush_deadline(now)
+                if deadline is None:
+                    continue
+                if deadline <= now:
+                    bridge.flush(self._cyw)
+                    flushed = True
+                elif next_deadline is None or deadline < next_deadline:
+                    next_deadline = deadline
+            if flushed:
+                continue  # check again, more data might have arrived while sending
+            timeout = None
+            if next_deadline is not None:
+                timeout = next_deadline - now
+            if self._rx_paused:
+                if self._cyw.get_buffered_amount() <= self._low_watermark:
+                    self.low_watermark_callback(self._cyw.get_buffered_amount())
+                    continue
+                if timeout is None or timeout > self._resume_check_interval:
+                    timeout = self._resume_check_interval
+            # sleep until a serial port delivers more data or one of the flush deadlines expires
+            self._rx_event.wait(timeout)
+            self._rx_event.clear()
         return False
 
     def connection_status_callback(self, connected):
@@ -125,14 +671,81 @@ class ControlYourWay:
         else:
             print('\nConnection failed\n')
 
+    def high_watermark_callback(self, buffered_bytes):
+        self._cyw.log_application_message(logging.DEBUG, 'Serial ports paused, %d bytes waiting' % buffered_bytes)
+        self._rx_paused = True
+        for bridge in self._bridges:
+            bridge.pause_rx()
+        self._rx_event.set()  # the collector thread checks the send buffer while the ports are paused
+
+    def low_watermark_callback(self, buffered_bytes):
+        self._cyw.log_application_message(logging.DEBUG, 'Serial ports resumed, %d bytes waiting' % buffered_bytes)
+        self._rx_paused = False
+        for bridge in self._bridges:
+            bridge.resume_rx()
+
+    def write_drop_callback(self, data_type, size):
+        self._cyw.log_application_message(logging.WARNING, 'Serial port write queue full, %d bytes dropped, data '
+                                                           'type: %s' % (size, data_type))
+
     def data_received_callback(self, data, data_type, from_who):
-        self._serial_port.send_data(data)
+        if len(self._bridges) == 1:
+            # a single serial port receives all data, regardless of the data type
+            self._bridges[0].send_data(data)
+        elif data_type in self._bridges_by_datatype:
+            self._bridges_by_datatype[data_type].send_data(data)
+        else:
+            self._cyw.log_application_message(logging.DEBUG, 'No serial port for data type: ' + data_type)
         #print(data)
 
-    # callback which will be called by serial port when data is received
-    def data_received(self, c):
-        self._send_data_collected += c.decode()
-        #print(c)
+
+def create_serial_port_bridge(config, section, default_datatype):
+    param_serial_port_name = config.get(section, "serport")
+    param_parity = config.get(section, "parity")
+    param_baudrate = config.get(section, "baudrate")
+    param_number_of_bits = config.get(section, "numbits")
+    param_stop_bits = config.get(section, "stopbits")
+    param_read_mode = config.get(section, "readmode", fallback="bulk")
+    param_max_chunk_size = config.get(section, "maxchunksize", fallback="4096")
+    param_write_queue_size = config.get(section, "writequeuesize", fallback="256")
+    param_write_queue_timeout = config.get(section, "writequeuetimeout", fallback="10")
+    param_datatype = config.get(section, "datatype", fallback=default_datatype)
+    param_payload_mode = config.get(section, "payloadmode", fallback="text")
+    param_rx_buffer_size = int(config.get(section, "rxbuffersize", fallback="65536"))
+    param_flush_policy = FlushPolicy(config.get(section, "flushbytes", fallback="1024"),
+                                     config.get(section, "flushidle", fallback="1000"),
+                                     config.get(section, "flushmaxlatency", fallback="10000"))
+    serial_port = SerialPort(param_serial_port_name)
+    serial_port.set_parity(param_parity)
+    serial_port.set_baudrate(param_baudrate)
+    serial_port.set_number_of_bits(param_number_of_bits)
+    serial_port.set_stop_bits(param_stop_bits)
+    serial_port.set_read_mode(param_read_mode)
+    serial_port.set_max_chunk_size(param_max_chunk_size)
+    serial_port.set_write_queue_size(param_write_queue_size)
+    serial_port.set_write_queue_timeout(param_write_queue_timeout)
+    serial_port.set_flow_control(config.get(section, "flowcontrol", fallback="none"),
+                                 config.get(section, "flowcontrolhigh", fallback="65536"),
+                                 config.get(section, "flowcontrollow", fallback="16384"))
+    param_framing = config.get(section, "framing", fallback="none")
+    if param_framing == "delimiter":
+        framer = DelimiterFramer(bytes.fromhex(config.get(section, "framedelimiter", fallback="0a")))
+    elif param_framing == "lengthprefix":
+        framer = LengthPrefixFramer(config.get(section, "lengthprefixsize", fallback="2"),
+                                    config.get(section, "lengthprefixorder", fallback="big"))
+    elif param_framing == "slip":
+        framer = SlipFramer()
+    elif param_framing == "cobs":
+        framer = CobsFramer()
+    elif param_framing == "idlegap":
+        framer = IdleGapFramer(param_baudrate)
+    else:
+        framer = None
+    bridge = SerialPortBridge(serial_port, param_datatype, param_rx_buffer_size, param_flush_policy,
+                              param_payload_mode, framer)
+    serial_port.open_serial_port()
+    return bridge
+
 
 if __name__ == "__main__":
     # see if the user specified a settings file
@@ -144,6 +757,7 @@ if __name__ == "__main__":
         print('Error: Could not load settings file: ' + settings_filename)
         sys.exit()
     network_names_option = "network"
+    serial_port_section = "SerialPortSettings"
     config = configparser.ConfigParser()
     config.read(settings_filename)
     connection_list = config.options("ControlYourWayConnectionDetails")
@@ -157,21 +771,21 @@ if __name__ == "__main__":
     if config.get("ControlYourWayConnectionDetails", "useWebsocket") == "0":
         param_cyw_use_websocket = False
     param_cyw_log_directory = config.get("ControlYourWayConnectionDetails", "logDirectory")
+    param_cyw_send_window = config.getint("ControlYourWayConnectionDetails", "sendWindow", fallback=1)
+    param_cyw_spool_directory = config.get("ControlYourWayConnectionDetails", "spoolDirectory", fallback="")
+    param_cyw_spool_max_size = config.getint("ControlYourWayConnectionDetails", "spoolMaxSize", fallback=67108864)
     param_cyw_network_names = []
     for item in connection_list:  #search for network names
         if item[:len(network_names_option)] == network_names_option:
             param_cyw_network_names.append(config.get("ControlYourWayConnectionDetails", item))
-    param_serial_port_name = config.get("SerialPortSettings", "serport")
-    param_parity = config.get("SerialPortSettings", "parity")
-    param_baudrate = config.get("SerialPortSettings", "baudrate")
-    param_number_of_bits = config.get("SerialPortSettings", "numbits")
-    param_stop_bits = config.get("SerialPortSettings", "stopbits")
-    serial_port = SerialPort(param_serial_port_name)
-    serial_port.set_parity(param_parity)
-    serial_port.set_baudrate(param_baudrate)
-    serial_port.set_number_of_bits(param_number_of_bits)
-    serial_port.set_stop_bits(param_stop_bits)
-    serial_port.open_serial_port()
-    cyw = ControlYourWay(param_cyw_username, param_cyw_password, serial_port, param_cyw_encryption,
-                         param_cyw_use_websocket, param_cyw_network_names, param_cyw_datatype, param_cyw_log_directory)
+    # every section starting with SerialPortSettings opens one serial port, all sharing the same connection
+    serial_port_bridges = []
+    for section in config.sections():
+        if section[:len(serial_port_section)] == serial_port_section:
+            serial_port_bridges.append(create_serial_port_bridge(config, section, param_cyw_datatype))
+    cyw = ControlYourWay(param_cyw_username, param_cyw_password, serial_port_bridges, param_cyw_encryption,
+                         param_cyw_use_websocket, param_cyw_network_names, param_cyw_log_directory,
+                         send_window=param_cyw_send_window, spool_directory=param_cyw_spool_directory,
+                         spool_max_size=param_cyw_spool_max_size)
+    cyw.run()
     print("Program finished")
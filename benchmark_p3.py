@@ -0,0 +1,409 @@
+"""
+Throughput and latency benchmark for PythonCywSerialPort_p3.py
+
+Pseudo terminals (os.openpty) are used in place of real serial ports and a loopback stand-in replaces the
+connection to the Control Your Way server, so the benchmark runs on any Linux machine without network access.
+With --cyw-server the real ControlYourWay_p3 library is used instead, connected to the local test server in
+CywTestServer_p3.py, which measures the whole path including the protocol.
+Every message starts with an 8 digit sequence number and ends with a newline, the time each message was
+written is compared with the time it arrived on the other side to calculate the one-way latency.
+
+Examples:
+python3 benchmark_p3.py
+python3 benchmark_p3.py --direction up --size 64 --count 20000 --rate 2000
+python3 benchmark_p3.py --direction down --size 1024 --count 2000 --framing delimiter
+python3 benchmark_p3.py --cyw-server --long-polling --count 2000
+python3 benchmark_p3.py --codec --size 100000
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import tty
+
+import ControlYourWay_p3
+import CywTestServer_p3
+import PythonCywSerialPort_p3
+
+
+class LoopbackInterface:
+    # Stand-in for ControlYourWay_p3.CywInterface. Data sent to the cloud is handed to on_send_data instead and
+    # inject_data() delivers data as if it was received from the cloud
+    def __init__(self):
+        self.name = ''
+        self.on_send_data = None
+        self._data_received_callback = None
+
+    def set_user_name(self, user_name):
+        return '0'
+
+    def set_network_password(self, network_password):
+        return '0'
+
+    def set_network_names(self, network_names):
+        return '0'
+
+    def set_connection_status_callback(self, cb):
+        pass
+
+    def set_data_received_callback(self, cb):
+        self._data_received_callback = cb
+
+    def set_receive_bytes(self, receive_bytes):
+        pass
+
+    def set_send_window(self, send_window):
+        pass
+
+    def set_send_buffer_watermarks(self, high_watermark, low_watermark):
+        pass
+
+    def set_high_watermark_callback(self, cb):
+        pass
+
+    def set_low_watermark_callback(self, cb):
+        pass
+
+    def get_buffered_amount(self):
+        return 0
+
+    def enable_logging(self, log_filename, log_level, enable_console_logging):
+        pass
+
+    def log_application_message(self, log_level, message):
+        pass
+
+    def set_use_encryption(self, value):
+        pass
+
+    def set_use_websocket(self, use_websocket):
+        pass
+
+    def start(self):
+        return '0'
+
+    def close_connection(self, clear_callbacks=False):
+        pass
+
+    def send_data(self, send_data):
+        if self.on_send_data is not None:
+            self.on_send_data(send_data.data)
+        return '0'
+
+    def inject_data(self, data, data_type):
+        if self._data_received_callback is not None:
+            self._data_received_callback(data, data_type, 1)
+
+
+class MessageTracker:
+    # Splits received data into messages and records the latency of every message
+    def __init__(self, send_times):
+        self._send_times = send_times
+        self._pending = b''
+        self.latencies = []
+        self.bytes_received = 0
+        self.messages_received = 0
+        self.done = threading.Event()
+
+    def add(self, data):
+        now = time.perf_counter()
+        self.bytes_received += len(data)
+        lines = (self._pending + data).split(b'\n')
+        self._pending = lines.pop()
+        for line in lines:
+            sequence = int(line[:8])
+            self.latencies.append(now - self._send_times[sequence])
+            self.messages_received += 1
+        if self.messages_received >= len(self._send_times):
+            self.done.set()
+
+
+def build_message(sequence, size):
+    header = b'%08d' % sequence
+    return header + b'x' * max(0, size - len(header) - 1) + b'\n'
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def open_pty_serial_port(args):
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(master_fd)
+    tty.setraw(slave_fd)
+    serial_port = PythonCywSerialPort_p3.SerialPort(os.ttyname(slave_fd))
+    serial_port.set_baudrate(args.baudrate)
+    serial_port.set_read_mode(args.read_mode)
+    serial_port.set_max_chunk_size(args.max_chunk_size)
+    serial_port.set_flow_control(args.flow_control, args.flow_control_high, args.flow_control_low)
+    return master_fd, slave_fd, serial_port
+
+
+def create_framer(args):
+    if args.framing == 'delimiter':
+        return PythonCywSerialPort_p3.DelimiterFramer(b'\n')
+    return None
+
+
+def pace(start_time, sequence, rate):
+    if rate > 0:
+        delay = start_time + sequence / float(rate) - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def run_direction(args, direction):
+    master_fd, slave_fd, serial_port = open_pty_serial_port(args)
+    flush_policy = PythonCywSerialPort_p3.FlushPolicy(args.flush_bytes, args.flush_idle, args.flush_max_latency)
+    bridge = PythonCywSerialPort_p3.SerialPortBridge(serial_port, 'benchmark', args.rx_buffer_size, flush_policy,
+                                                     'binary', create_framer(args))
+    serial_port.open_serial_port()
+    send_times = [0.0] * args.count
+    tracker = MessageTracker(send_times)
+    server = None
+    if args.cyw_server:
+        server = CywTestServer_p3.CywTestServer('localhost', 0, latency=args.server_latency / 1000.0,
+                                                download_timeout=5)
+        server.start()
+        interface = ControlYourWay_p3.CywInterface()
+        interface.set_use_test_server(True, server.get_server_name())
+        if direction == 'up':
+            server.on_data_message = lambda message: tracker.add(message.data.encode('latin-1'))
+        inject_data = lambda data: server.inject(data.decode('latin-1'), 'benchmark')
+    else:
+        interface = LoopbackInterface()
+        if direction == 'up':
+            interface.on_send_data = tracker.add
+        inject_data = lambda data: interface.inject_data(data, 'benchmark')
+    cyw = PythonCywSerialPort_p3.ControlYourWay('benchmark', 'benchmark', [bridge], False, not args.long_polling,
+                                                ['benchmark'], '', interface, args.send_window)
+    if direction == 'down':
+        def read_master():
+            while not tracker.done.is_set():
+                try:
+                    data = os.read(master_fd, 65536)
+                except OSError:
+                    break
+                if data:
+                    tracker.add(data)
+        reader = threading.Thread(target=read_master)
+        reader.daemon = True
+        reader.start()
+    cyw.start()
+    if server is not None:
+        # wait until the library is connected and listening before starting the clock
+        deadline = time.perf_counter() + args.timeout
+        while time.perf_counter() < deadline and not (interface.connected and
+                                                       any(s.networks for s in server.get_sessions())):
+            time.sleep(0.01)
+    cpu_start = time.process_time()
+    start_time = time.perf_counter()
+    for sequence in range(args.count):
+        pace(start_time, sequence, args.rate)
+        message = build_message(sequence, args.size)
+        send_times[sequence] = time.perf_counter()
+        if direction == 'up':
+            os.write(master_fd, message)
+        else:
+            inject_data(message)
+    deadline = time.perf_counter() + args.timeout
+    while not tracker.done.is_set() and time.perf_counter() < deadline:
+        if tracker.messages_received + serial_port.write_queue_dropped >= args.count:
+            break  # messages dropped because the write queue was full will never arrive
+        tracker.done.wait(0.01)
+    elapsed = time.perf_counter() - start_time
+    cpu_used = time.process_time() - cpu_start
+    cyw.stop()
+    os.close(master_fd)
+    os.close(slave_fd)
+    if server is not None:
+        server.stop()
+    latencies = sorted(tracker.latencies)
+    return {
+        'direction': direction,
+        'messages': tracker.messages_received,
+        'lost': args.count - tracker.messages_received,
+        'bytes_per_second': tracker.bytes_received / elapsed,
+        'messages_per_second': tracker.messages_received / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'p999': percentile(latencies, 0.999),
+        'cpu_percent': 100.0 * cpu_used / elapsed,
+        'overruns': bridge.get_rx_buffer().overruns,
+        'write_queue_dropped': serial_port.write_queue_dropped,
+        'write_queue_high_water': serial_port.write_queue_high_water,
+        'rx_pauses': serial_port.rx_pauses,
+    }
+
+
+def print_result(result):
+    print('%-4s messages: %d (lost %d), %.0f bytes/s, %.0f messages/s' %
+          (result['direction'], result['messages'], result['lost'], result['bytes_per_second'],
+           result['messages_per_second']))
+    print('     latency p50: %.3f ms, p99: %.3f ms, p999: %.3f ms' %
+          (result['p50'] * 1000, result['p99'] * 1000, result['p999'] * 1000))
+    print('     cpu: %.1f%%, rx buffer overruns: %d, write queue dropped: %d, write queue high water: %d, '
+          'rx pauses: %d' % (result['cpu_percent'], result['overruns'], result['write_queue_dropped'],
+                             result['write_queue_high_water'], result['rx_pauses']))
+
+
+def reference_tilde_encode_data(data):
+    # the tilde encoding of the library before it worked on bytes, used as the reference for --codec
+    encoded = ''
+    for i in range(0, len(data)):
+        if data[i] == '~':
+            encoded += '~~'
+        elif ord(data[i]) == 0:
+            encoded += '~-'
+        else:
+            encoded += data[i]
+    return encoded
+
+
+def reference_decode_cyw_protocol(rawdata):
+    # the protocol decoder of the library before it worked on bytes, used as the reference for --codec
+    cyw_dict = ControlYourWay_p3.CreateCywDictionary()
+    state_key = 0
+    state_value = 1
+    state_control_char_in_value = 2
+    state = state_key
+    the_key = ''
+    the_value = ''
+    control_char = '~'
+    end_of_key = '='
+
+    # convert byte array to string
+    data_type = type(rawdata)
+    if data_type == str:
+        data = rawdata
+    else:
+        data = ''
+        for b in rawdata:
+            data += chr(b)
+
+    if data[0] != '~':
+        return   # protocol problem
+    for i in range(1, len(data)):
+        c = data[i]
+        last_char = False
+        if i == len(data) - 1:
+            last_char = True
+        if state == state_key:
+            if last_char or c == control_char:
+                return cyw_dict
+            if c == end_of_key:
+                state = state_value
+            else:
+                the_key += c
+        elif state == state_value:
+            if c == control_char:
+                if last_char:
+                    return   # last character cannot be a control character
+                else:
+                    state = state_control_char_in_value
+            else:
+                the_value += c
+                if last_char:
+                    cyw_dict.keys.append(the_key)
+                    cyw_dict.values.append(the_value)
+        elif state == state_control_char_in_value:
+            if c == control_char:
+                # double tilde means a tilde was sent
+                the_value += c
+                state = state_value
+                if last_char:
+                    cyw_dict.keys.append(the_key)
+                    cyw_dict.values.append(the_value)
+            elif c == '-':
+                # this means a zero was sent in the string
+                the_value += chr(0)
+                state = state_value
+                if last_char:
+                    cyw_dict.keys.append(the_key)
+                    cyw_dict.values.append(the_value)
+            else:
+                if last_char:
+                    return   # last character cannot be a control character
+                else:
+                    cyw_dict.keys.append(the_key)
+                    cyw_dict.values.append(the_value)
+                    the_key = ''
+                    the_value = ''
+                    the_key += c
+                    state = state_key
+    return cyw_dict
+
+
+def time_function(fn, count):
+    # return the average number of seconds one call of fn takes
+    start_time = time.perf_counter()
+    for i in range(count):
+        fn()
+    return (time.perf_counter() - start_time) / count
+
+
+def run_codec(args):
+    # time the tilde codec of the library on a random binary payload of args.size bytes and compare it with the
+    # string based codec the library used before, which worked on one character at a time
+    payload = os.urandom(args.size)
+    message = b'~rt=r~f=1~dt=benchmark~d=' + ControlYourWay_p3.CywInterface.tilde_encode_data(payload)
+    reference_payload = payload.decode('latin-1')
+    for name, fn, reference_fn in (
+            ('encode', lambda: ControlYourWay_p3.CywInterface.tilde_encode_data(payload),
+             lambda: reference_tilde_encode_data(reference_payload)),
+            ('decode', lambda: ControlYourWay_p3.CywInterface.decode_cyw_protocol(message, ('d',)),
+             lambda: reference_decode_cyw_protocol(message))):
+        elapsed = time_function(fn, args.count)
+        reference_elapsed = time_function(reference_fn, args.count)
+        print('%s: %.3f ms per %d byte payload, %.1f MB/s, reference: %.3f ms, %.1f MB/s, %.1fx faster' %
+              (name, elapsed * 1000, args.size, args.size / elapsed / 1000000, reference_elapsed * 1000,
+               args.size / reference_elapsed / 1000000, reference_elapsed / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serial bridge throughput and latency benchmark')
+    parser.add_argument('--direction', choices=['up', 'down', 'both'], default='both',
+                        help='up: serial port to cloud, down: cloud to serial port')
+    parser.add_argument('--size', type=int, default=64, help='message size in bytes')
+    parser.add_argument('--count', type=int, default=10000, help='number of messages per direction')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, 0 sends as fast as possible')
+    parser.add_argument('--baudrate', type=int, default=115200)
+    parser.add_argument('--read-mode', choices=['bulk', 'byte'], default='bulk')
+    parser.add_argument('--max-chunk-size', type=int, default=4096)
+    parser.add_argument('--rx-buffer-size', type=int, default=65536)
+    parser.add_argument('--flush-bytes', type=int, default=1024)
+    parser.add_argument('--flush-idle', type=int, default=1000, help='microseconds')
+    parser.add_argument('--flush-max-latency', type=int, default=10000, help='microseconds')
+    parser.add_argument('--framing', choices=['none', 'delimiter'], default='none')
+    parser.add_argument('--flow-control', choices=['none', 'stopreading', 'rtscts', 'xonxoff'], default='none')
+    parser.add_argument('--flow-control-high', type=int, default=65536, help='bytes waiting to be sent to the cloud')
+    parser.add_argument('--flow-control-low', type=int, default=16384)
+    parser.add_argument('--cyw-server', action='store_true',
+                        help='use the ControlYourWay_p3 library connected to a local CywTestServer_p3 server')
+    parser.add_argument('--long-polling', action='store_true', help='use long polling instead of WebSocket')
+    parser.add_argument('--send-window', type=int, default=1, help='uploads waiting for a response at the same time')
+    parser.add_argument('--server-latency', type=float, default=0,
+                        help='milliseconds the test server adds to every response and delivered message')
+    parser.add_argument('--codec', action='store_true',
+                        help='only time the tilde encoding and decoding of a --size byte payload, --count times, '
+                             'and compare it with the codec the library used before')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for all messages to arrive')
+    args = parser.parse_args()
+    if args.codec:
+        run_codec(args)
+        return 0
+    if args.size < 9:
+        parser.error('--size must be at least 9 bytes')
+    directions = ['up', 'down'] if args.direction == 'both' else [args.direction]
+    for direction in directions:
+        print_result(run_direction(args, direction))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
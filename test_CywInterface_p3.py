@@ -0,0 +1,221 @@
+"""
+Tests for the upload path of ControlYourWay_p3.py, against the local test server in CywTestServer_p3.py.
+Run with: python3 -m unittest test_CywInterface_p3
+"""
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import ControlYourWay_p3
+import CywTestServer_p3
+
+
+class ErrorResponse:
+    def __init__(self, status):
+        self.status = status
+
+    def read(self, size=None):
+        return b''
+
+    def close(self):
+        pass
+
+
+class FailingRequests:
+    # wraps CywConnectionPool.request, the next `failures` requests to `page` raise ConnectionRefusedError, or get
+    # a response with the HTTP status `status` if it is not None
+    def __init__(self, connection_pool, page='/Upload', failures=0, status=None):
+        self.request = connection_pool.request
+        self.page = page
+        self.failures = failures
+        self.status = status
+        self.failed = 0
+        self.lock = threading.Lock()
+        connection_pool.request = self
+
+    def __call__(self, host, port, encrypted, timeout, method, page, body, headers):
+        with self.lock:
+            fail = page.startswith(self.page) and self.failures > 0
+            if fail:
+                self.failures -= 1
+                self.failed += 1
+        if fail:
+            if self.status is not None:
+                response = ErrorResponse(self.status)
+                return response, response
+            raise ConnectionRefusedError('connection refused by the test')
+        return self.request(host, port, encrypted, timeout, method, page, body, headers)
+
+
+class CywInterfaceTest(unittest.TestCase):
+    def setUp(self):
+        self.server = CywTestServer_p3.CywTestServer(port=0, download_timeout=2)
+        self.server.start()
+        self.received = []
+        self.errors = []
+        self.interfaces = []
+
+    def tearDown(self):
+        for cyw in self.interfaces:
+            cyw.close_connection(True)
+        self.server.stop()
+
+    def create_interface(self, spool_directory=None, use_websocket=False):
+        cyw = ControlYourWay_p3.CywInterface()
+        cyw.set_use_test_server(True, self.server.get_server_name())
+        cyw.set_user_name('user')
+        cyw.set_network_password('password')
+        cyw.set_network_names(['net'])
+        cyw.set_use_websocket(use_websocket)
+        if spool_directory is not None:
+            cyw.set_spool_directory(spool_directory)
+        cyw.set_data_received_callback(lambda data, data_type, from_who: self.received.append(data))
+        cyw.set_error_callback(self.errors.append)
+        self.interfaces.append(cyw)
+        return cyw
+
+    def start(self, cyw):
+        cyw.start()
+        self.wait_for(lambda: cyw.connected)
+
+    @staticmethod
+    def wait_for(condition, timeout=10):
+        end_time = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > end_time:
+                raise AssertionError('timed out')
+            time.sleep(0.01)
+
+    @staticmethod
+    def send(cyw, data):
+        send_data = ControlYourWay_p3.CreateSendData()
+        send_data.data = data
+        send_data.data_type = 'test'
+        send_data.to_networks = ['net']
+        return cyw.send_data(send_data)
+
+    def test_failed_request_is_retried(self):
+        receiver = self.create_interface()
+        sender = self.create_interface()
+        self.start(receiver)
+        self.start(sender)
+        requests = FailingRequests(sender._CywInterface__locals.connection_pool, failures=2)
+        self.send(sender, 'x')
+        self.wait_for(lambda: self.received == ['x'])
+        self.assertEqual(requests.failed, 2)
+        self.assertEqual(self.errors, [])
+
+    def test_failed_requests_in_flight_are_retried(self):
+        receiver = self.create_interface()
+        sender = self.create_interface()
+        sender.set_send_window(4)
+        sender.set_max_messages_per_packet(1)
+        self.start(receiver)
+        self.start(sender)
+        requests = FailingRequests(sender._CywInterface__locals.connection_pool, failures=3)
+        for i in range(8):
+            self.send(sender, str(i))
+        self.wait_for(lambda: len(self.received) == 8)
+        self.assertEqual(sorted(self.received), [str(i) for i in range(8)])
+        self.assertEqual(requests.failed, 3)
+        self.assertEqual(self.errors, [])
+
+    def test_error_callback_after_max_retries(self):
+        sender = self.create_interface()
+        self.start(sender)
+        FailingRequests(sender._CywInterface__locals.connection_pool, failures=100)
+        self.send(sender, 'x')
+        self.wait_for(lambda: '20' in self.errors)
+        self.assertEqual(sender.get_counters().data_lane.depth, 0)
+
+    def test_websocket_response_for_unknown_upload_is_ignored(self):
+        receiver = self.create_interface()
+        sender = self.create_interface(use_websocket=True)
+        self.start(receiver)
+        self.start(sender)
+        locals_ = sender._CywInterface__locals
+        self.wait_for(lambda: locals_.websocket_state == locals_.constants.ws_state_running)
+        self.server.latency = 0.5
+        self.send(sender, 'x')
+        self.wait_for(lambda: len(locals_.master_vars.packets_in_flight) == 1)
+        # a late response to an upload that timed out must not be taken for the upload that is in flight
+        locals_.websocket_receive_queue.put(ControlYourWay_p3.CywInterface.decode_cyw_protocol(b'~rt=s~e=0~z=999'))
+        locals_.master_wakeup.set()
+        time.sleep(0.2)
+        self.assertEqual(len(locals_.master_vars.packets_in_flight), 1)
+        self.wait_for(lambda: self.received == ['x'])
+        self.wait_for(lambda: len(locals_.master_vars.packets_in_flight) == 0)
+
+    def test_websocket_connection_is_created_again_after_it_closed(self):
+        receiver = self.create_interface()
+        sender = self.create_interface(use_websocket=True)
+        self.start(receiver)
+        self.start(sender)
+        locals_ = sender._CywInterface__locals
+        self.wait_for(lambda: locals_.websocket_state == locals_.constants.ws_state_running)
+        websocket = locals_.websocket
+        websocket.close()
+        self.wait_for(lambda: locals_.websocket is not websocket, timeout=20)
+        self.wait_for(lambda: locals_.websocket_state == locals_.constants.ws_state_running)
+        self.send(sender, 'x')
+        self.wait_for(lambda: self.received == ['x'])
+
+    def test_download_errors_are_not_retried_immediately(self):
+        cyw = self.create_interface()
+        self.start(cyw)
+        locals_ = cyw._CywInterface__locals
+        requests = FailingRequests(locals_.connection_pool, locals_.download_page, failures=100, status=500)
+        cyw.set_network_names(['other'])  # cancels the download request that is waiting
+        time.sleep(2)
+        # the first error waits download_error_wait_time seconds before the next request
+        self.assertEqual(requests.failed, 1)
+
+    def test_string_encoding(self):
+        receiver = self.create_interface()
+        sender = self.create_interface()
+        self.start(receiver)
+        self.start(sender)
+        # latin-1 by default, every byte value round trips
+        binary = ''.join(chr(i) for i in range(256))
+        self.send(sender, binary)
+        self.wait_for(lambda: self.received == [binary])
+        with self.assertRaises(UnicodeEncodeError):
+            self.send(sender, 'caf\u00e9\u20ac')
+        receiver.set_string_encoding('utf-8')
+        sender.set_string_encoding('utf-8')
+        self.send(sender, 'caf\u00e9\u20ac')
+        self.wait_for(lambda: self.received == [binary, 'caf\u00e9\u20ac'])
+
+    def test_watermark_callbacks_follow_the_buffered_amount(self):
+        # the send buffer is emptied while the high watermark callback runs, the low watermark callback must follow
+        cyw = ControlYourWay_p3.CywInterface()
+        send_queue = cyw._CywInterface__locals.to_master_for_cloud_queue
+        callbacks = []
+        cyw.set_send_buffer_watermarks(1000, 500)
+        cyw.set_high_watermark_callback(lambda buffered: (callbacks.append(('high', buffered)), send_queue.drain()))
+        cyw.set_low_watermark_callback(lambda buffered: callbacks.append(('low', buffered)))
+        self.send(cyw, 'x' * 2000)
+        self.assertEqual(callbacks, [('high', 2000), ('low', 0)])
+        self.assertEqual(cyw.get_buffered_amount(), 0)
+
+    def test_spooled_upload_is_sent_again_after_max_retries(self):
+        spool_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_directory)
+        receiver = self.create_interface()
+        sender = self.create_interface(spool_directory)
+        self.start(receiver)
+        self.start(sender)
+        # the first upload and all its retries fail, the data stays in the spool and is sent again later
+        requests = FailingRequests(sender._CywInterface__locals.connection_pool, failures=4)
+        self.send(sender, 'x')
+        self.wait_for(lambda: self.received == ['x'], timeout=20)
+        self.assertEqual(requests.failed, 4)
+        self.assertEqual(self.errors, ['20'])
+        self.wait_for(lambda: sender.get_buffered_amount() == 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
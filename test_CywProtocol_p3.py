@@ -0,0 +1,83 @@
+"""
+Tests for the protocol encoding, the stream decoder and the queue of ControlYourWay_p3.py.
+Run with: python3 -m unittest test_CywProtocol_p3
+"""
+
+import random
+import unittest
+
+import ControlYourWay_p3
+
+CywInterface = ControlYourWay_p3.CywInterface
+
+
+def create_message(data):
+    return b'~rt=d~dt=serial~d=' + CywInterface.tilde_encode_data(data) + b'~t=1'
+
+
+class CywProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.random = random.Random(1)
+        # data with many tildes, zeros and the characters of the terminator
+        self.samples = [b'', b'~', b'~~', b'\x00', b'~-', b'~t=1', b'~~t=1', b'a~', b'\x00~\x00~~'] + \
+            [bytes(self.random.choice(b'~\x00t=1-ab') for i in range(self.random.randint(1, 50))) for i in range(200)]
+
+    def test_encode_decode_round_trip(self):
+        for data in self.samples + [bytes(range(256))]:
+            cyw_dict = CywInterface.decode_cyw_protocol(create_message(data), ('d',))
+            self.assertEqual(cyw_dict.get_single_value('d'), data)
+            self.assertEqual(cyw_dict.get_single_value('dt'), 'serial')
+
+    def test_encode_decode_round_trip_str(self):
+        for data in self.samples:
+            text = data.decode('latin-1')
+            cyw_dict = CywInterface.decode_cyw_protocol('~d=' + CywInterface.tilde_encode_data(text) + '~t=1')
+            self.assertEqual(cyw_dict.get_single_value('d'), text)
+
+    def test_stream_decoder_chunk_boundaries(self):
+        stream = b''.join(create_message(data) for data in self.samples)
+        for chunk_size in (1, 2, 3, 5, 64, len(stream)):
+            decoder = ControlYourWay_p3.CywStreamDecoder()
+            messages = []
+            for i in range(0, len(stream), chunk_size):
+                messages += decoder.feed(stream[i:i + chunk_size])
+            self.assertEqual([cyw_dict.get_single_value('d') for cyw_dict in messages], self.samples)
+            self.assertEqual(decoder.get_buffered_size(), 0)
+
+    def test_stream_decoder_overflow(self):
+        decoder = ControlYourWay_p3.CywStreamDecoder(max_buffer_size=100)
+        self.assertEqual(decoder.feed(create_message(b'x' * 200)[:150]), [])
+        self.assertEqual(decoder.overflows, 1)
+        # the rest of the message that was too long is discarded, the next message is decoded
+        messages = decoder.feed(create_message(b'x' * 200)[150:] + create_message(b'y'))
+        self.assertEqual([cyw_dict.get_single_value('d') for cyw_dict in messages], [b'y'])
+
+
+class CywQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = ControlYourWay_p3.CywQueue(item_size=len)
+
+    def test_drain_limits(self):
+        for item in (b'aaaa', b'bb', b'cccc', b'd'):
+            self.queue.put(item)
+        self.assertEqual(self.queue.drain(max_bytes=7), [b'aaaa', b'bb'])
+        self.assertEqual(self.queue.drain(max_items=1), [b'cccc'])
+        self.assertEqual(self.queue.get_bytes(), 1)
+        # the first item is always returned, even if it is larger than max_bytes
+        self.queue.put(b'eeeeee')
+        self.assertEqual(self.queue.drain(max_bytes=0), [b'd'])
+        self.assertEqual(self.queue.drain(max_bytes=2), [b'eeeeee'])
+        self.assertEqual(self.queue.drain(), [])
+        self.assertEqual(self.queue.get_bytes(), 0)
+
+    def test_unshift_keeps_order(self):
+        for item in (b'a', b'b', b'c', b'd'):
+            self.queue.put(item)
+        items = self.queue.drain(max_items=3)
+        self.queue.unshift(*items[1:])
+        self.assertEqual(self.queue.drain(), [b'b', b'c', b'd'])
+        self.assertEqual(self.queue.get_bytes(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+Tests for the disk spool of ControlYourWay_p3.py. Run with: python3 -m unittest test_CywSpool_p3
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+import ControlYourWay_p3
+
+
+def create_packet(i):
+    packet = ControlYourWay_p3.CreateSendData()
+    packet.data = b'%04d' % i
+    packet.data_type = 'serial'
+    return packet
+
+
+class CywSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = ControlYourWay_p3.CywSpool(self.directory, segment_size=4096)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+    def assert_counts_match_drain(self):
+        size = self.spool.get_size()
+        size_bytes = self.spool.get_bytes()
+        empty = self.spool.empty()
+        packets = self.spool.drain()
+        self.assertEqual(len(packets), size)
+        self.assertEqual(empty, size == 0)
+        record_header_size = ControlYourWay_p3.CywSpool.record_header_size
+        self.assertEqual(sum(end - offset - record_header_size for number, offset, end in
+                             (p.spool_record for p in packets)), size_bytes)
+        return packets
+
+    def test_rewind_then_ack(self):
+        # upload 2 timed out and was rewound, then the response of upload 1 arrived
+        for i in range(10):
+            self.spool.put(create_packet(i))
+        upload1 = self.spool.drain(max_items=5)
+        self.spool.drain(max_items=5)
+        self.spool.rewind()
+        self.spool.ack(upload1)
+        packets = self.assert_counts_match_drain()
+        self.assertEqual([p.data for p in packets], [b'%04d' % i for i in range(5, 10)])
+        self.assertEqual(self.spool.get_size(), 0)
+        self.assertEqual(self.spool.get_bytes(), 0)
+
+    def test_ack_out_of_order_after_rewind(self):
+        for i in range(300):
+            self.spool.put(create_packet(i))
+        uploads = [self.spool.drain(max_items=50) for i in range(6)]
+        self.spool.rewind()
+        self.spool.ack(uploads[3])
+        self.spool.ack(uploads[0])
+        self.spool.ack(uploads[1])
+        # upload 3 is sent again, only the packets before the first packet that was not acknowledged are skipped
+        packets = self.assert_counts_match_drain()
+        self.assertEqual(len(packets), 200)
+        self.assertEqual(packets[0].data, b'0100')
+
+    def test_unshift(self):
+        for i in range(10):
+            self.spool.put(create_packet(i))
+        packets = self.spool.drain()
+        self.spool.unshift(*packets[4:])
+        self.spool.ack(packets[:4])
+        self.assertEqual([p.data for p in self.assert_counts_match_drain()], [b'%04d' % i for i in range(4, 10)])
+
+    def test_reopen_sends_unacknowledged_packets(self):
+        for i in range(300):
+            self.spool.put(create_packet(i))
+        self.spool.ack(self.spool.drain(max_items=120))
+        self.spool.close()
+        self.spool = ControlYourWay_p3.CywSpool(self.directory, segment_size=4096)
+        packets = self.assert_counts_match_drain()
+        self.assertEqual([p.data for p in packets], [b'%04d' % i for i in range(120, 300)])
+
+    def write_segment(self, number, version, payloads):
+        spool_class = ControlYourWay_p3.CywSpool
+        data = struct.pack(spool_class.header_format, spool_class.magic, version, spool_class.header_size)
+        for payload in payloads:
+            data += struct.pack(spool_class.record_format, len(payload), zlib.crc32(payload)) + payload
+        path = os.path.join(self.directory, 'cyw_spool_%010d.seg' % number)
+        with open(path, 'wb') as f:
+            f.write(data.ljust(4096, b'\x00'))
+        return path
+
+    def test_version_1_segment_is_read(self):
+        # version 1 records do not have the time the packet was queued
+        self.spool.close()
+        self.write_segment(0, 1, [b'serial\x001\x00net\x000\x00%04d' % i for i in range(3)])
+        self.spool = ControlYourWay_p3.CywSpool(self.directory, segment_size=4096)
+        self.spool.put(create_packet(3))
+        packets = self.assert_counts_match_drain()
+        self.assertEqual([p.data for p in packets], [b'%04d' % i for i in range(4)])
+        self.assertEqual(packets[0].to_networks, ['net'])
+        self.spool.ack(packets)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['cyw_spool_0000000001.seg'])
+
+    def test_unknown_version_segment_is_kept(self):
+        self.spool.close()
+        path = self.write_segment(0, 99, [b'data'])
+        with open(path, 'rb') as f:
+            contents = f.read()
+        self.spool = ControlYourWay_p3.CywSpool(self.directory, segment_size=4096)
+        self.spool.put(create_packet(0))
+        self.assertEqual([p.data for p in self.assert_counts_match_drain()], [b'0000'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+
+
+if __name__ == '__main__':
+    unittest.main()
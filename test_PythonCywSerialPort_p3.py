@@ -0,0 +1,163 @@
+"""
+Tests for the serial bridge, the framers and the rx buffer of PythonCywSerialPort_p3.py.
+Run with: python3 -m unittest test_PythonCywSerialPort_p3
+"""
+
+import time
+import unittest
+
+import PythonCywSerialPort_p3
+
+
+class FakeInterface:
+    # stand-in for ControlYourWay_p3.CywInterface with a send buffer amount that is set by the test
+    def __init__(self):
+        self.buffered_amount = 0
+        self.high_watermark_callback = None
+        self.low_watermark_callback = None
+
+    def __getattr__(self, name):
+        # the setters that are not used by the tests do nothing
+        if name.startswith('set_') or name in ('enable_logging', 'log_application_message', 'start',
+                                               'close_connection'):
+            return lambda *args: None
+        raise AttributeError(name)
+
+    def set_high_watermark_callback(self, cb):
+        self.high_watermark_callback = cb
+
+    def set_low_watermark_callback(self, cb):
+        self.low_watermark_callback = cb
+
+    def get_buffered_amount(self):
+        return self.buffered_amount
+
+
+class FakeBridge:
+    def __init__(self):
+        self.paused = False
+
+    def get_datatype(self):
+        return 'serial'
+
+    def set_rx_event(self, rx_event):
+        pass
+
+    def set_write_drop_callback(self, write_drop_callback):
+        pass
+
+    def get_flow_control(self):
+        return 'stopreading', 1000, 100
+
+    def get_flush_deadline(self, now):
+        return None
+
+    def pause_rx(self):
+        self.paused = True
+
+    def resume_rx(self):
+        self.paused = False
+
+    def close(self):
+        pass
+
+
+class FlowControlTest(unittest.TestCase):
+    def setUp(self):
+        self.interface = FakeInterface()
+        self.bridge = FakeBridge()
+        self.cyw = PythonCywSerialPort_p3.ControlYourWay('user', 'password', [self.bridge], False, False, ['net'],
+                                                         '', self.interface)
+        self.cyw._resume_check_interval = 0.01
+
+    def tearDown(self):
+        self.cyw.stop()
+
+    def wait_for(self, condition, timeout=5):
+        end_time = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > end_time:
+                raise AssertionError('timed out')
+            time.sleep(0.01)
+
+    def test_resume_after_high_then_low(self):
+        self.cyw.start()
+        self.interface.buffered_amount = 2000
+        self.interface.high_watermark_callback(2000)
+        self.assertTrue(self.bridge.paused)
+        self.interface.buffered_amount = 0
+        self.interface.low_watermark_callback(0)
+        self.assertFalse(self.bridge.paused)
+
+    def test_resume_when_low_watermark_callback_was_missed(self):
+        # the buffer was emptied but the low watermark callback never came, the ports must not stay paused
+        self.cyw.start()
+        self.interface.buffered_amount = 2000
+        self.interface.high_watermark_callback(2000)
+        time.sleep(0.05)
+        self.assertTrue(self.bridge.paused)
+        self.interface.buffered_amount = 50
+        self.wait_for(lambda: not self.bridge.paused)
+
+
+
+
+class FramerTest(unittest.TestCase):
+    # a framer returns the end of the last frame that was completed by a chunk. This must not depend on how the
+    # received data was split into chunks
+    def check_chunks(self, create_framer, data, frame_ends):
+        for chunk_size in (1, 2, 3, 7, len(data)):
+            framer = create_framer()
+            for pos in range(0, len(data), chunk_size):
+                chunk = data[pos:pos + chunk_size]
+                ends = [end - pos for end in frame_ends if pos < end <= pos + len(chunk)]
+                self.assertEqual(framer.feed(chunk, 0), max(ends) if ends else -1, (chunk_size, pos))
+
+    def test_delimiter_framer(self):
+        self.check_chunks(PythonCywSerialPort_p3.DelimiterFramer, b'ab\ncd\n\nefg\nh', [3, 6, 7, 11])
+
+    def test_delimiter_framer_multiple_bytes(self):
+        self.check_chunks(lambda: PythonCywSerialPort_p3.DelimiterFramer(b'\r\n'), b'ab\r\n\r\rcd\r\n\ne\r', [4, 10])
+
+    def test_slip_and_cobs_framers(self):
+        self.check_chunks(PythonCywSerialPort_p3.SlipFramer, b'\xc0ab\xc0\xdb\xdc\xc0c', [1, 4, 7])
+        self.check_chunks(PythonCywSerialPort_p3.CobsFramer, b'\x03ab\x00\x01\x00\x02c', [4, 6])
+
+    def test_length_prefix_framer(self):
+        self.check_chunks(PythonCywSerialPort_p3.LengthPrefixFramer, b'\x00\x03abc\x00\x00\x00\x01d\x00\x05ef',
+                          [5, 7, 10])
+        self.check_chunks(lambda: PythonCywSerialPort_p3.LengthPrefixFramer(3, 'little'),
+                          b'\x02\x00\x00ab\x01\x00\x00c', [5, 9])
+
+    def test_idle_gap_framer(self):
+        framer = PythonCywSerialPort_p3.IdleGapFramer(9600)
+        self.assertAlmostEqual(framer.idle_gap, 3.5 * 11 / 9600)
+        self.assertEqual(framer.feed(b'ab', framer.idle_gap / 2), -1)
+        self.assertEqual(framer.feed(b'cd', framer.idle_gap), 0)
+        self.assertEqual(PythonCywSerialPort_p3.IdleGapFramer(115200).idle_gap, 0.00175)
+
+
+class ByteRingBufferTest(unittest.TestCase):
+    def test_wraparound(self):
+        ring = PythonCywSerialPort_p3.ByteRingBuffer(8)
+        self.assertEqual(ring.write(b'abcdef'), 6)
+        ring.consume(4)
+        # the data wraps around the end of the buffer and is returned as two views
+        self.assertEqual(ring.write(b'ghijk'), 5)
+        self.assertEqual([bytes(view) for view in ring.peek()], [b'efgh', b'ijk'])
+        self.assertEqual(b''.join(ring.peek(5)), b'efghi')
+        ring.consume(5)
+        self.assertEqual(len(ring), 2)
+        self.assertEqual(b''.join(ring.peek()), b'jk')
+
+    def test_overrun(self):
+        ring = PythonCywSerialPort_p3.ByteRingBuffer(8)
+        self.assertEqual(ring.write(b'abcdef'), 6)
+        self.assertEqual(ring.write(b'ghij'), 2)
+        self.assertEqual(ring.write(b'k'), 0)
+        self.assertEqual((ring.overruns, ring.overrun_bytes), (2, 3))
+        self.assertEqual(b''.join(ring.peek()), b'abcdefgh')
+
+
+if __name__ == '__main__':
+    unittest.main()